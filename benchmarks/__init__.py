@@ -0,0 +1,4 @@
+"""Benchmarks of vkbackup stages against local stand-ins of vk api and media servers.
+
+Run with ``python -m benchmarks.run --help``.
+"""
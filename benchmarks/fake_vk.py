@@ -0,0 +1,84 @@
+import json
+import random
+import re
+import threading
+import time
+from typing import Dict, List
+
+from vk.exceptions import VkAPIError
+
+GET_HISTORY_CALL = re.compile(r'API\.messages\.getHistory\((\{.*?\})\)')
+
+
+class FakeVkAPI:
+    """In-process stand-in of vk api serving prepared conversations.
+
+    Supports the calls vkbackup makes: messages.getHistory, messages.getDialogs, users.get
+    and execute made of messages.getHistory calls. Every call waits for latency seconds
+    and fails with error 6 (too many requests) with probability error_rate.
+    """
+
+    def __init__(self, dialogs: Dict[int, List[Dict]], users: List[Dict],
+                 latency: float = 0.0, error_rate: float = 0.0, seed: int = 0) -> None:
+        """
+        :param dialogs: dict from uid of peer to its messages in chronological order
+        :param users: user objects returned by users.get
+        :param latency: seconds every call takes
+        :param error_rate: probability of call to fail with error 6
+        :param seed: random seed for error injection
+        """
+        self.dialogs = dialogs
+        self.users_by_key = {}
+        for user in users:
+            self.users_by_key[str(user['uid'])] = user
+            self.users_by_key[user['screen_name']] = user
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.messages = _Namespace(getHistory=self._wrap('messages.getHistory', self.get_history),
+                                   getDialogs=self._wrap('messages.getDialogs', self.get_dialogs))
+        self.users = _Namespace(get=self._wrap('users.get', self.get_users))
+        self.execute = self._wrap('execute', self.execute_code)
+
+    def _wrap(self, name, method):
+        def call(**params):
+            with self.lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                fail = self.rng.random() < self.error_rate
+            if self.latency:
+                time.sleep(self.latency)
+            if fail:
+                raise VkAPIError(dict(error_code=6, error_msg='Too many requests per second',
+                                      request_params=[dict(key='method', value=name)]))
+            return method(**params)
+        return call
+
+    def get_history(self, offset=0, count=20, user_id=None, chat_id=None, rev=0, v=None, **params) -> List:
+        msgs = self.dialogs.get(int(user_id if user_id is not None else chat_id), [])
+        offset, count = int(offset), min(int(count), 200)
+        if int(rev):
+            page = msgs[offset:offset + count]
+        else:
+            page = msgs[::-1][offset:offset + count]
+        return [len(msgs)] + page
+
+    def get_dialogs(self, offset=0, count=20, v=None, **params) -> List:
+        last = [msgs[-1] for msgs in self.dialogs.values() if msgs]
+        last.sort(key=lambda msg: -msg['date'])
+        return [len(last)] + last[int(offset):int(offset) + min(int(count), 200)]
+
+    def get_users(self, user_ids='', fields=None, v=None, **params) -> List[Dict]:
+        return [self.users_by_key[key] for key in str(user_ids).split(',') if key in self.users_by_key]
+
+    def execute_code(self, code='', v=None, **params) -> List:
+        result = []
+        for call in GET_HISTORY_CALL.findall(code):
+            result += self.get_history(**json.loads(call))
+        return result
+
+
+class _Namespace:
+    def __init__(self, **methods) -> None:
+        self.__dict__.update(methods)
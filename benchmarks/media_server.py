@@ -0,0 +1,120 @@
+import hashlib
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCALE = dict(xs=16, s=8, m=2)  # times photo with size suffix is smaller than photo_size
+
+
+def make_image(width: int = 1280, height: int = 960) -> bytes:
+    """JPEG image of photo size, with noise so it compresses like a photo."""
+    from PIL import Image
+
+    image = Image.merge('RGB', [Image.effect_noise((width, height), sigma) for sigma in (40, 60, 80)])
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+class MediaServer:
+    """Local http server returning deterministic content for any path.
+
+    Content of a path is the same on every request, file size is size_for(path), and
+    Range, HEAD and If-None-Match requests are supported, so resumed, repeated and
+    conditional downloads can be checked. Photos with size suffix, like /photo/1_s.jpg,
+    are smaller the smaller the suffix is, as versions of one photo on vk cdn are.
+
+    Use as context manager, url of server is in ``url``.
+    """
+
+    def __init__(self, latency: float = 0.0, photo_size: int = 100 * 1024, audio_size: int = 4 * 2 ** 20,
+                 images: bool = False) -> None:
+        """
+        :param latency: seconds before every response
+        :param photo_size: size of every file except those under /audio
+        :param audio_size: size of files under /audio
+        :param images: files under /photo are real 1280x960 JPEG images, photo_size is ignored for them;
+                       needs Pillow
+        """
+        self.latency = latency
+        self.photo_size = photo_size
+        self.audio_size = audio_size
+        self.image = make_image() if images else None
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as real cdn does
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+            def do_HEAD(self):
+                server.handle(self, head=True)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+
+    def size_for(self, path: str) -> int:
+        if self.image and path.startswith('/photo'):
+            return len(self.image) + 32
+        if path.startswith('/audio'):
+            return self.audio_size
+        suffix = path.rsplit('.', 1)[0].rsplit('_', 1)[-1]
+        return self.photo_size // SCALE.get(suffix, 1) if path.startswith('/photo') else self.photo_size
+
+    def content(self, path: str) -> bytes:
+        block = hashlib.sha256(path.encode('utf-8')).digest()
+        if self.image and path.startswith('/photo'):
+            return self.image + block  # bytes after the end of JPEG are ignored by readers, but make files differ
+        size = self.size_for(path)
+        return (block * (size // len(block) + 1))[:size]
+
+    def handle(self, request: BaseHTTPRequestHandler, head: bool = False) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        body = self.content(request.path.split('?', 1)[0])
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.end_headers()
+            with self.lock:
+                self.requests += 1
+            return
+        start = 0
+        range_header = request.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[len('bytes='):].split('-', 1)[0])
+            if start >= len(body):
+                request.send_response(416)
+                request.send_header('Content-Length', '0')
+                request.end_headers()
+                return
+            request.send_response(206)
+            request.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+        else:
+            request.send_response(200)
+        request.send_header('Content-Length', str(len(body) - start))
+        request.send_header('ETag', etag)
+        request.end_headers()
+        if not head:
+            request.wfile.write(body[start:])
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += 0 if head else len(body) - start
+
+    def __enter__(self) -> 'MediaServer':
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
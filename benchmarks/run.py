@@ -0,0 +1,183 @@
+"""Benchmark vkbackup stages on synthetic dialogs, without token or network.
+
+Example::
+
+    python -m benchmarks.run --messages 1000 100000 --latency 0.05 --json bench.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from benchmarks import synthetic
+from benchmarks.fake_vk import FakeVkAPI
+from benchmarks.media_server import MediaServer
+from vkbackup import archive, html_backup, pipeline, vk_msg
+from vkbackup.downloader import Downloader
+from vkbackup.ratelimit import RateLimiter
+from vkbackup.store import MessageStore
+from vkbackup.thumbnails import Thumbnailer
+
+PEER = 2
+
+
+def stage_fetch(ctx: Dict) -> int:
+    ctx['msgs'] = ctx['m'].get_all_from(PEER)
+    return len(ctx['msgs'])
+
+
+def stage_participants(ctx: Dict) -> int:
+    ctx['participants'] = ctx['m'].participants(ctx['msgs'])
+    return len(ctx['msgs'])
+
+
+def stage_links(ctx: Dict) -> int:
+    index = vk_msg.index_attachments(ctx['msgs'])
+    ctx['audio'] = vk_msg.audio_links(ctx['msgs'], index)
+    ctx['photo'] = vk_msg.photo_links(ctx['msgs'], index)
+    return len(ctx['msgs'])
+
+
+def stage_text(ctx: Dict) -> int:
+    with open(os.devnull, 'w', encoding='utf-8') as f:
+        for line in vk_msg.iter_text(ctx['msgs'], ctx['participants'], processes=ctx['args'].processes):
+            print(line, file=f)
+    return len(ctx['msgs'])
+
+
+def stage_html_repr(ctx: Dict) -> int:
+    for _ in html_backup.iter_html_repr(ctx['msgs'], ctx['participants']):
+        pass
+    return len(ctx['msgs'])
+
+
+def stage_render(ctx: Dict) -> int:
+    html_backup.render(ctx['tmp'], str(PEER), ctx['msgs'], ctx['participants'], ctx['audio'], ctx['photo'],
+                       processes=ctx['args'].processes)
+    return len(ctx['msgs'])
+
+
+def stage_archive(ctx: Dict) -> int:
+    archive.make(ctx['tmp'], str(PEER), ctx['msgs'], ctx['participants'], ctx['audio'], ctx['photo'],
+                 Downloader(ctx['args'].workers), thumbnailer=Thumbnailer() if ctx['args'].images else None,
+                 photo_size=ctx['args'].photo_tier)
+    return len(ctx['photo']) + len(ctx['audio'])
+
+
+def stage_pipeline(ctx: Dict) -> int:
+    store = MessageStore(os.path.join(ctx['tmp'], 'pipeline.db'))
+    summary = pipeline.archive_peer(os.path.join(ctx['tmp'], 'pipeline'), ctx['m'], store, PEER, str(PEER),
+                                    downloader=Downloader(ctx['args'].workers),
+                                    thumbnailer=Thumbnailer() if ctx['args'].images else None)
+    return summary['messages']
+
+
+STAGES = {
+    'fetch': stage_fetch,
+    'participants': stage_participants,
+    'links': stage_links,
+    'text': stage_text,
+    'html_repr': stage_html_repr,
+    'render': stage_render,
+    'archive': stage_archive,
+    'pipeline': stage_pipeline,
+}
+
+
+def measure(stage: Callable[[Dict], int], ctx: Dict, memory: bool) -> Dict:
+    """Run stage, measuring wall time and peak of memory allocated during it."""
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    items = stage(ctx)
+    wall = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if memory else None
+    if memory:
+        tracemalloc.stop()
+    return dict(items=items, wall=wall, throughput=items / wall if wall else None,
+                peak_mb=peak / 2 ** 20 if peak is not None else None)
+
+
+def run(args: argparse.Namespace, n: int, media: MediaServer) -> List[Dict]:
+    users = synthetic.users(args.users)
+    msgs = list(synthetic.dialog(n, peer=PEER, n_users=args.users, media_url=media.url, seed=args.seed))
+    api = FakeVkAPI({PEER: msgs}, users, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    tmp = tempfile.mkdtemp(prefix='vkbackup-bench-')
+    ctx = dict(args=args, tmp=tmp, m=vk_msg.VkMessages(api, RateLimiter(args.rate, burst=args.burst),
+                                                             fetch_workers=args.fetch_workers))
+    results = []
+    requests_before, bytes_before = media.requests, media.bytes_sent
+    try:
+        for name in args.stages:
+            if name != 'fetch' and 'msgs' not in ctx:  # stages after fetch need messages
+                ctx['msgs'] = msgs
+            if name in ('text', 'render', 'archive', 'html_repr') and 'participants' not in ctx:
+                stage_participants(ctx)
+            if name in ('render', 'archive') and 'photo' not in ctx:
+                stage_links(ctx)
+            result = measure(STAGES[name], ctx, args.memory)
+            result.update(stage=name, messages=n)
+            results.append(result)
+            print(format_row(result), file=sys.stderr)
+        results.append(dict(stage='api calls', messages=n, calls=dict(api.calls)))
+        results.append(dict(stage='media', messages=n, requests=media.requests - requests_before,
+                            bytes=media.bytes_sent - bytes_before))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def format_row(result: Dict) -> str:
+    return '{messages:>9} {stage:<13} {wall:>9.3f}s {throughput:>12.1f}/s {peak}'.format(
+        peak='{:.1f} MB peak'.format(result['peak_mb']) if result['peak_mb'] is not None else '',
+        **result)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description='Benchmark vkbackup stages on synthetic data.')
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000, 10000],
+                        help='dialog sizes to run (default: %(default)s)')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help='stages to run, in order (default: all)')
+    parser.add_argument('--users', type=int, default=50, help='authors of forwarded messages (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per api call (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of api calls failing with error 6 (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='api requests per second allowed by limiter (default: %(default)s)')
+    parser.add_argument('--fetch-workers', type=int, default=3,
+                        help='concurrent history requests (default: %(default)s)')
+    parser.add_argument('--burst', type=int, default=1, help='limiter burst (default: %(default)s)')
+    parser.add_argument('--media-latency', type=float, default=0.0,
+                        help='seconds before every media response (default: %(default)s)')
+    parser.add_argument('--photo-size', type=int, default=50 * 1024, help='bytes per photo (default: %(default)s)')
+    parser.add_argument('--photo-tier', choices=sorted(vk_msg.PHOTO_SIZES), default='original',
+                        help='photo size downloaded by archive stage (default: %(default)s)')
+    parser.add_argument('--audio-size', type=int, default=256 * 1024, help='bytes per audio (default: %(default)s)')
+    parser.add_argument('--images', action='store_true',
+                        help='serve real JPEG photos and make thumbnails of them in archive stage, needs Pillow')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes of text and render stages, 0 for one per cpu core (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=8, help='media download workers (default: %(default)s)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='do not trace memory, it slows stages down noticeably')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=str, help='write results to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+    with MediaServer(args.media_latency, args.photo_size, args.audio_size, args.images) as media:
+        for n in args.messages:
+            results += run(args, n, media)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+import random
+from typing import Dict, Iterator, List
+
+START_DATE = 1420070400  # 2015-01-01
+WORDS = ('привет', 'как', 'дела', 'hello', 'ok', 'да', 'нет', 'завтра', 'photo', 'смотри',
+         'link', 'встреча', 'в', 'на', 'lol', 'почему', 'когда', 'good', 'night', 'утро')
+
+
+def users(n: int) -> List[Dict]:
+    """User objects as returned by users.get, uids are 1..n."""
+    return [dict(uid=uid, first_name='User{}'.format(uid), last_name='Test', screen_name='id{}'.format(uid))
+            for uid in range(1, n + 1)]
+
+
+def attachment(rng: random.Random, n: int, media_url: str) -> Dict:
+    """Random attachment, media urls point to media_url."""
+    kind = rng.choice(('photo', 'photo', 'photo', 'audio', 'sticker', 'doc', 'link', 'video', 'wall'))
+    if kind == 'photo':
+        return dict(type='photo', photo=dict(
+            pid=n, src='{}/photo/{}_s.jpg'.format(media_url, n), src_small='{}/photo/{}_xs.jpg'.format(media_url, n),
+            src_big='{}/photo/{}_m.jpg'.format(media_url, n), src_xbig='{}/photo/{}_x.jpg'.format(media_url, n)))
+    if kind == 'audio':
+        return dict(type='audio', audio=dict(
+            aid=n, artist='Artist {}'.format(n % 97), title='Track {}'.format(n),
+            url='{}/audio/{}.mp3'.format(media_url, n)))
+    if kind == 'sticker':
+        return dict(type='sticker', sticker=dict(
+            photo_64='{}/sticker/{}_64.png'.format(media_url, n % 50),
+            photo_128='{}/sticker/{}_128.png'.format(media_url, n % 50),
+            photo_256='{}/sticker/{}_256.png'.format(media_url, n % 50)))
+    if kind == 'doc':
+        return dict(type='doc', doc=dict(title='doc{}.pdf'.format(n), ext='pdf', size=1024 * n % 10 ** 6,
+                                         url='{}/doc/{}.pdf'.format(media_url, n)))
+    if kind == 'link':
+        return dict(type='link', link=dict(title='Link {}'.format(n), url='https://example.com/{}'.format(n)))
+    if kind == 'video':
+        return dict(type='video', video=dict(title='Video {}'.format(n),
+                                             image='{}/video/{}.jpg'.format(media_url, n)))
+    return dict(type='wall', wall=dict(text=text(rng), attachments=[attachment(rng, n + 1, media_url)]
+                                       if rng.random() < 0.5 else []))
+
+
+def text(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 25)))
+
+
+def dialog(n: int, peer: int = 2, me: int = 1, n_users: int = 50, forward_rate: float = 0.05,
+           attachment_rate: float = 0.1, media_url: str = 'http://127.0.0.1:8000',
+           seed: int = 0) -> Iterator[Dict]:
+    """Synthetic dialog in the shape of messages.getHistory of api version 4.100.
+
+    Same arguments always give the same messages.
+
+    :param n: number of messages
+    :param peer: uid of the other side
+    :param me: uid of the user making the backup
+    :param n_users: authors of forwarded messages are taken from uids 1..n_users
+    :param forward_rate: share of messages with forwarded messages
+    :param attachment_rate: share of messages with attachments
+    :param media_url: base url of media in attachments
+    :param seed: random seed
+    :return: generator of messages in chronological order
+    """
+    rng = random.Random(seed)
+    date = START_DATE
+    for i in range(n):
+        date += rng.randint(1, 3600)
+        out = rng.random() < 0.5
+        msg = dict(mid=i + 1, date=date, out=int(out), uid=peer, from_id=me if out else peer,
+                   read_state=1, title=' ... ', body=text(rng))
+        if rng.random() < attachment_rate:
+            msg['attachments'] = [attachment(rng, i * 4 + k, media_url) for k in range(rng.randint(1, 3))]
+        if rng.random() < forward_rate:
+            msg['fwd_messages'] = [
+                dict(uid=rng.randint(1, n_users), date=date - rng.randint(60, 10 ** 6), body=text(rng),
+                     **({'attachments': [attachment(rng, i * 4 + 3, media_url)]} if rng.random() < 0.3 else {}))
+                for _ in range(rng.randint(1, 4))
+            ]
+        yield msg
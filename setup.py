@@ -10,4 +10,5 @@ setup(name='vkbackup',
       packages=['vkbackup'],
       zip_safe=False,
       scripts=['bin/vkbackup'],
-      requires=['jinja2', 'typing', 'vk'])
+      requires=['jinja2', 'typing', 'vk'],
+      extras_require={'thumbnails': ['Pillow']})
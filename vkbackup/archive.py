@@ -1,46 +1,256 @@
 import os
+from urllib.parse import quote, urlsplit
 
-import requests
-from tqdm import tqdm
+from vkbackup import html_backup, vk_msg
+from vkbackup.blobs import BlobStore
+from vkbackup.downloader import Downloader
 
-from vkbackup import html_backup
+
+MEDIA_FOLDERS = ('photo', 'audio', 'sticker', 'video')
 
 
 def normalize_string(s):
     return s.replace(r'/', r'.')
 
 
-def make(path, peer_id, msgs, participants, audio, photo):
-    peer_path = os.path.join(path, peer_id)
-    photo_path = os.path.join(peer_path, 'photo')
-    audio_path = os.path.join(peer_path, 'audio')
+def url_name(url, parts=1):
+    """File name made of last parts of url path."""
+    return '_'.join(urlsplit(url).path.rstrip('/').split('/')[-parts:])
 
-    if not os.path.exists(photo_path):
-        os.makedirs(photo_path)
-    if not os.path.exists(audio_path):
-        os.makedirs(audio_path)
 
-    html_backup.render(peer_path, peer_id, msgs, participants, audio, photo)
+def media_files(peer_path, msgs, audio, photo, index=None, taken=None):
+    """Local files of media of conversation.
 
+    :param peer_path: folder of peer in archive
+    :param msgs: list of messages
+    :param audio: audio objects made by vk_msg.audio_links
+    :param photo: photo objects made by vk_msg.photo_links
+    :param index: index made by vk_msg.index_attachments, to avoid walking messages again
+    :param taken: paths given to files already, when messages come in batches; it is updated
+    :return: dict from url to local paths
+    """
+    photo_path, audio_path, sticker_path, video_path = (os.path.join(peer_path, folder) for folder in MEDIA_FOLDERS)
+    if index is None:
+        index = vk_msg.index_attachments(msgs)
     photo_links = [p['biggest'] for p in photo]
     valid_audio = [a for a in audio if a.get('url', None)]
 
-    for link in tqdm(photo_links, desc='Downloading photos', unit='photo'):
-        resp = requests.get(link, stream=True)
-        filename = resp.url.rsplit('/', 1)[-1]
-        file = os.path.join(photo_path, filename)
-        if os.path.isfile(file):
-            continue
-        with open(file, 'wb') as f:
-            for data in tqdm(resp.iter_content(), desc=filename, unit='b'):
-                f.write(data)
-
-    for audio_info in tqdm(valid_audio, desc='Downloading audios', unit='audio'):
-        resp = requests.get(audio_info['url'], stream=True)
+    files = {}  # url -> local paths, every url is downloaded once
+    taken = set() if taken is None else taken
+    for link in photo_links:
+        file = os.path.join(photo_path, urlsplit(link).path.rsplit('/', 1)[-1])
+        if file not in taken:
+            taken.add(file)
+            files.setdefault(link, []).append(file)
+    for audio_info in valid_audio:
         filename = "{} - {}.mp3".format(audio_info['artist'], audio_info['title'][:30])  # slicing to 30 to avoid long titles
         file = os.path.join(audio_path, normalize_string(filename))
-        if os.path.isfile(file):
-            continue
-        with open(file, 'wb') as f:
-            for data in tqdm(resp.iter_content(), desc=filename, unit='b'):
-                f.write(data)
+        if file not in taken:
+            taken.add(file)
+            files.setdefault(audio_info['url'], []).append(file)
+    for sticker in vk_msg.attachments_of_type(msgs, 'sticker', index):
+        link = sticker['sticker'].get('photo_128')
+        file = os.path.join(sticker_path, url_name(link, 2)) if link else None  # sticker urls end with size
+        if file and file not in taken:
+            taken.add(file)
+            files.setdefault(link, []).append(file)
+    for video in vk_msg.attachments_of_type(msgs, 'video', index):
+        link = video['video'].get('image')
+        file = os.path.join(video_path, url_name(link)) if link else None
+        if file and file not in taken:
+            taken.add(file)
+            files.setdefault(link, []).append(file)
+    return files
+
+
+def download_plan(files, photo, blobs, photo_size='original', revalidate=False, originals=None):
+    """What to download for media files of conversation.
+
+    Photos not stored yet are downloaded in photo_size version, see vk_msg.photo_url, and their
+    local files are linked to it; originals of them are left for fetch_originals.
+    Files present but absent in manifest come from archives made before it was introduced, they
+    are kept as they are.
+
+    :param files: dict from url to local paths made by media_files
+    :param photo: photo objects made by vk_msg.photo_links
+    :param blobs: media store
+    :param photo_size: size tier of photos, one of vk_msg.PHOTO_SIZES
+    :param revalidate: if True, stored files not revalidated during this run yet are downloaded
+                       again with conditional requests, only changed ones are transferred
+    :param originals: dict from original photo url to local files linked to smaller version;
+                      it is updated
+    :return: (dict from url of files to url to download, list of urls to download)
+    """
+    smaller = {p['biggest']: vk_msg.photo_url(p, photo_size) for p in photo if p['biggest'] in files}
+    # files of photo linked to smaller version by earlier run are in manifest under url of that version
+    versions = {p['biggest']: [p[field] for field in vk_msg.PHOTO_FIELDS if p.get(field)] for p in photo}
+    sources = {}
+    wanted = []
+    for url, paths in files.items():
+        source = smaller.get(url) or url
+        if blobs.get(url) is not None:
+            source = url  # original is stored already
+        elif blobs.get(source) is None:
+            if all(blobs.manifest.get(v) is None for v in versions.get(url, [url])) \
+                    and all(map(os.path.isfile, paths)):
+                source = url
+            else:
+                wanted.append(source)
+        sources[url] = source
+        if source != url and originals is not None:
+            originals.setdefault(url, []).extend(paths)
+    if revalidate:
+        wanted += blobs.unchecked(list(sources.values()))
+    return sources, list(dict.fromkeys(wanted))
+
+
+def fetch_originals(blobs, downloader, originals):
+    """Download original photos of files linked to smaller versions by make, and link files to them.
+
+    Html refers to the files rather than to blobs, so it needs no rendering again.
+
+    :param blobs: media store
+    :param downloader: media downloader
+    :param originals: dict from original photo url to local files, filled by make
+    """
+    ext = {url: os.path.splitext(paths[0])[1] for url, paths in originals.items()}
+    claimed = blobs.claim([url for url in originals if blobs.get(url) is None])
+    try:
+        downloader.download(
+            [(url, blobs.incoming_path(url)) for url in claimed], 'Downloading original photos',
+            on_done=lambda url, file, sha256, validators: blobs.add(url, file, os.path.getsize(file), sha256,
+                                                                     ext[url], validators)
+        )
+    finally:
+        blobs.release(claimed)
+        blobs.save()
+    blobs.wait(list(originals))
+    for url, paths in originals.items():
+        if blobs.get(url) is not None:
+            for file in paths:
+                blobs.link(url, file)
+
+
+def make(path, peer_id, msgs, participants, audio, photo, downloader=None, page_by='month', page_size=1000,
+         blobs=None, thumbnailer=None, index=None, processes=1, photo_size='original', revalidate=False,
+         originals=None):
+    """Download media of conversation and render html referring to local files only.
+
+    Photos, audios, stickers and video previews are kept in folders of peer_path; thumbnails
+    of photos are made in thumbs folder. Media that failed to download stays linked to vk.com.
+
+    :param path: archive root
+    :param peer_id: id or screen name of peer, name of its folder
+    :param msgs: list of messages
+    :param participants: participants dict
+    :param audio: audio objects made by vk_msg.audio_links
+    :param photo: photo objects made by vk_msg.photo_links
+    :param downloader: media downloader, shared between peers archived at the same time
+    :param page_by: 'month' or 'count', see html_backup.paginate
+    :param page_size: messages per page when paginating by count
+    :param blobs: media store, shared between peers archived at the same time
+    :param thumbnailer: makes thumbnails of photos, None to link originals only
+    :param index: index made by vk_msg.index_attachments, to avoid walking messages again
+    :param processes: number of processes rendering pages, None for one per cpu core
+    :param photo_size: size tier of photos to download, see download_plan
+    :param revalidate: if True, stored media are downloaded again if they changed, see download_plan
+    :param originals: dict filled with original photos to fetch later by fetch_originals
+    """
+    peer_path = os.path.join(path, peer_id)
+    thumb_path = os.path.join(peer_path, 'thumbs')
+    for folder in [os.path.join(peer_path, folder) for folder in MEDIA_FOLDERS] + [thumb_path]:
+        os.makedirs(folder, exist_ok=True)
+
+    files = media_files(peer_path, msgs, audio, photo, index)
+    photo_links = [p['biggest'] for p in photo]
+
+    blobs = blobs or BlobStore(path)  # shared between peers archived at the same time
+    sources, wanted = download_plan(files, photo, blobs, photo_size, revalidate, originals)
+    ext = {sources[url]: os.path.splitext(paths[0])[1] for url, paths in files.items()}
+    claimed = blobs.claim(wanted)
+    try:
+        (downloader or Downloader()).download(
+            [(url, blobs.incoming_path(url)) for url in claimed],
+            on_done=lambda url, file, sha256, validators: blobs.add(url, file, os.path.getsize(file), sha256,
+                                                                     ext[url], validators),
+            validators={url: blobs.validators(url) for url in claimed}
+        )
+    finally:
+        blobs.release(claimed)
+        blobs.save()
+    blobs.wait(list(sources.values()))  # urls claimed by other peers archived at the same time
+    for url, paths in files.items():
+        if blobs.get(sources[url]) is not None:
+            for file in paths:
+                blobs.link(sources[url], file)
+
+    def local(file):
+        return quote(os.path.relpath(file, peer_path).replace(os.sep, '/'))
+
+    media = {url: dict(file=local(paths[0])) for url, paths in files.items() if os.path.isfile(paths[0])}
+    if thumbnailer is not None:
+        thumbs = {url: os.path.join(thumb_path, os.path.splitext(os.path.basename(files[url][0]))[0] + '.jpg')
+                  for url in set(photo_links) if url in media}
+        made = set(thumbnailer.make([(files[url][0], thumb) for url, thumb in thumbs.items()]))
+        for url, thumb in thumbs.items():
+            if thumb in made:
+                media[url]['thumb'] = local(thumb)
+
+    html_backup.render(peer_path, peer_id, msgs, participants, audio, photo, page_by, page_size, media,
+                       processes=processes)
+
+
+def make_bundle(bundle, peer_id, msgs, participants, audio, photo, downloader=None, page_by='month',
+                page_size=1000, thumbnailer=None, index=None):
+    """Download media of conversation and render html into bundle, without folder tree on disk.
+
+    Every file is added to bundle as soon as it is downloaded and removed from disk; photos are kept
+    only until their thumbnails are made. Html is in <peer_id> folder of bundle, media it refers
+    to is shared by all peers. Media already in bundle is not downloaded again.
+
+    :param bundle: zip bundle, shared between peers archived at the same time
+    :param peer_id: id or screen name of peer, name of its folder in bundle
+    :param msgs: list of messages
+    :param participants: participants dict
+    :param audio: audio objects made by vk_msg.audio_links
+    :param photo: photo objects made by vk_msg.photo_links
+    :param downloader: media downloader, shared between peers archived at the same time
+    :param page_by: 'month' or 'count', see html_backup.paginate
+    :param page_size: messages per page when paginating by count
+    :param thumbnailer: makes thumbnails of photos, None to link originals only
+    :param index: index made by vk_msg.index_attachments, to avoid walking messages again
+    """
+    files = media_files(peer_id, msgs, audio, photo, index)
+    photo_links = {p['biggest'] for p in photo}
+    ext = {url: os.path.splitext(paths[0])[1] for url, paths in files.items()}
+    kept = {}  # url -> downloaded photo to make thumbnail of
+
+    def on_done(url, file, sha256, validators):
+        keep = thumbnailer is not None and url in photo_links
+        bundle.add(url, file, os.path.getsize(file), sha256, ext[url], keep)
+        if keep:
+            kept[url] = file
+
+    claimed = bundle.claim([url for url in files if bundle.get(url) is None])
+    try:
+        (downloader or Downloader()).download([(url, bundle.incoming_path(url)) for url in claimed],
+                                              on_done=on_done)
+        thumbs = {file + '.jpg': url for url, file in kept.items()}
+        for thumb in thumbnailer.make([(kept[url], thumb) for thumb, url in thumbs.items()]) if kept else []:
+            bundle.add_thumbnail(thumbs[thumb], thumb)
+    finally:
+        for file in kept.values():
+            os.remove(file)
+        bundle.release(claimed)
+        bundle.save()
+    bundle.wait(list(files))  # urls claimed by other peers archived at the same time
+
+    media = {}
+    for url in files:
+        entry = bundle.get(url)
+        if entry is not None:
+            media[url] = dict(file='../' + entry['member'])
+            if entry.get('thumb'):
+                media[url]['thumb'] = '../' + entry['thumb']
+    html_backup.render(peer_id, peer_id, msgs, participants, audio, photo, page_by, page_size, media,
+                       bundle.open_text)
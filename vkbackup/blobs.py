@@ -0,0 +1,130 @@
+import hashlib
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional
+
+from vkbackup.manifest import Manifest
+
+
+def link(src: str, dst: str) -> None:
+    """Make dst refer to the same data as src.
+
+    Hardlink is preferred, symlink is used where hardlinks are not supported, copy as the last resort.
+    """
+    if os.path.lexists(dst):
+        if os.path.isfile(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+
+class Claims:
+    """Bookkeeping of urls being downloaded, so peers archived at the same time fetch each url once."""
+
+    def __init__(self) -> None:
+        self.pending = set()  # urls being downloaded right now
+        self.downloaded = threading.Condition()
+
+    def claim(self, urls: List[str]) -> List[str]:
+        """Mark urls as being downloaded.
+
+        :param urls: urls caller wants to download
+        :return: those of urls nobody else is downloading now, caller must release them afterwards
+        """
+        with self.downloaded:
+            mine = [url for url in urls if url not in self.pending]
+            self.pending.update(mine)
+            return mine
+
+    def release(self, urls: List[str]) -> None:
+        """Mark claimed urls as no longer being downloaded."""
+        with self.downloaded:
+            self.pending.difference_update(urls)
+            self.downloaded.notify_all()
+
+    def wait(self, urls: List[str]) -> None:
+        """Wait until none of urls is being downloaded."""
+        with self.downloaded:
+            self.downloaded.wait_for(lambda: self.pending.isdisjoint(urls))
+
+
+class BlobStore(Claims):
+    """Content-addressed media store shared by all peers of an archive.
+
+    Every file is kept once under blobs/<first two hex digits>/<sha256><ext>; files in peer
+    folders are links to blobs. The manifest maps media urls to blobs, so a url is fetched once
+    and equal content fetched from different urls is stored once.
+    """
+
+    def __init__(self, root: str) -> None:
+        """
+        :param root: archive root
+        """
+        super().__init__()
+        self.root = root
+        self.blobs = os.path.join(root, 'blobs')
+        self.incoming = os.path.join(self.blobs, 'incoming')
+        os.makedirs(self.incoming, exist_ok=True)
+        self.manifest = Manifest(root)
+        self.checked = set()  # stored urls revalidated with server during this run
+        self.lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[str]:
+        """Path of stored file of url, None if it is not downloaded yet."""
+        return self.manifest.local_path(url)
+
+    def incoming_path(self, url: str) -> str:
+        """Where to download url to before adding it to the store.
+
+        Path depends only on url, so interrupted download is found and resumed by the next run.
+        """
+        return os.path.join(self.incoming, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def validators(self, url: str) -> Optional[Dict]:
+        """Validators of stored file of url for conditional requests, see Downloader.fetch; None if not stored."""
+        if self.get(url) is None:
+            return None
+        entry = self.manifest.get(url)
+        return {key: entry[key] for key in ('etag', 'last_modified', 'size') if entry.get(key) is not None}
+
+    def unchecked(self, urls: List[str]) -> List[str]:
+        """Those of stored urls not revalidated during this run yet, they are marked as revalidated."""
+        with self.lock:
+            mine = [url for url in dict.fromkeys(urls) if url not in self.checked and self.get(url) is not None]
+            self.checked.update(mine)
+            return mine
+
+    def add(self, url: str, path: str, size: int, sha256: str, ext: str = '', validators: Dict = None) -> str:
+        """Move downloaded file into the store.
+
+        :param url: url file came from
+        :param path: downloaded file, it is moved or removed if the same content is already stored
+        :param size: file size
+        :param sha256: hex digest of file
+        :param ext: extension of blob, like '.jpg'
+        :param validators: etag and last_modified of response, kept in manifest for conditional requests
+        :return: path of blob
+        """
+        blob_dir = os.path.join(self.blobs, sha256[:2])
+        blob = os.path.join(blob_dir, sha256 + ext)
+        os.makedirs(blob_dir, exist_ok=True)
+        if os.path.isfile(blob):
+            os.remove(path)
+        else:
+            os.replace(path, blob)
+        self.manifest.put(url, blob, size, sha256, **(validators or {}))
+        return blob
+
+    def link(self, url: str, path: str) -> None:
+        """Make path refer to stored file of url."""
+        link(self.get(url), path)
+
+    def save(self) -> None:
+        self.manifest.save()
@@ -0,0 +1,278 @@
+import hashlib
+import io
+import json
+import os
+import struct
+import threading
+import warnings
+import zipfile
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Optional, TextIO
+
+from vkbackup.blobs import Claims
+
+INDEX_DIR = 'index/'
+MEDIA_DIR = 'media/'
+THUMBS_DIR = 'thumbs/'
+# already compressed formats are stored as is, deflating them only costs time
+STORED_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.ogg', '.zip'))
+
+COMPACT_RATIO = 0.5  # bundle is rewritten on close when superseded members take more than this share of it
+COPY_CHUNK = 2 ** 20
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+
+
+def recover(path: str) -> int:
+    """Make zip file interrupted while members were appended readable again.
+
+    zipfile appends members over the central directory and writes the new one on close, so an
+    interrupted run leaves a file without directory. Members are found by walking local headers;
+    the file is cut after the last complete one and directory of the members before is written.
+
+    :param path: zip file
+    :return: number of recovered members
+    """
+    infos = []
+    end = 0
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            f.seek(end)
+            header = f.read(LOCAL_HEADER.size)
+            if len(header) < LOCAL_HEADER.size or header[:4] != LOCAL_HEADER_SIGNATURE:
+                break
+            (_, version, flags, method, dos_time, dos_date, crc, compress_size, file_size,
+             name_length, extra_length) = LOCAL_HEADER.unpack(header)
+            name = f.read(name_length)
+            f.read(extra_length)
+            data_end = end + LOCAL_HEADER.size + name_length + extra_length + compress_size
+            if flags & 0x08 or compress_size == 0xffffffff or data_end > size:
+                break  # sizes not in header, zip64 or truncated data: not written completely
+            f.seek(data_end)
+            following = f.read(4)
+            if following not in (b'', LOCAL_HEADER_SIGNATURE, CENTRAL_HEADER_SIGNATURE):
+                break  # header was not updated with real sizes yet
+            info = zipfile.ZipInfo(name.decode('utf-8' if flags & 0x800 else 'cp437'),
+                                   ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xf, dos_date & 0x1f,
+                                    dos_time >> 11, (dos_time >> 5) & 0x3f, (dos_time & 0x1f) * 2))
+            info.flag_bits = flags
+            info.compress_type = method
+            info.CRC = crc
+            info.compress_size = compress_size
+            info.file_size = file_size
+            info.header_offset = end
+            infos.append(info)
+            end = data_end
+    with open(path, 'r+b') as f:
+        f.truncate(end)
+    write_directory(path, infos, end)
+    return len(infos)
+
+
+def write_directory(path: str, infos: List[zipfile.ZipInfo], end: int) -> None:
+    """Write central directory of members to zip file made of local headers and data only.
+
+    :param path: zip file without directory
+    :param infos: members, with header_offset set
+    :param end: end of the last member
+    """
+    # without end record zipfile appends new directory after the data, members are then added to it
+    with zipfile.ZipFile(path, 'a') as z:
+        z.start_dir = end
+        for info in infos:
+            z.filelist.append(info)
+            z.NameToInfo[info.filename] = info
+
+
+def member_span(f: BinaryIO, info: zipfile.ZipInfo) -> int:
+    """Bytes taken by member in zip file, local header included."""
+    f.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    return LOCAL_HEADER.size + header[-2] + header[-1] + info.compress_size
+
+
+def compact(path: str, infos: List[zipfile.ZipInfo]) -> None:
+    """Rewrite zip file with only the given members, copying their data as is.
+
+    :param path: zip file
+    :param infos: members to keep, from directory of the file
+    """
+    tmp = path + '.tmp'
+    kept = []
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        for info in infos:
+            remaining = member_span(src, info)
+            src.seek(info.header_offset)
+            info.header_offset = dst.tell()
+            while remaining > 0:
+                data = src.read(min(COPY_CHUNK, remaining))
+                dst.write(data)
+                remaining -= len(data)
+            kept.append(info)
+        end = dst.tell()
+    write_directory(tmp, kept, end)
+    os.replace(tmp, path)
+
+
+class Bundle(Claims):
+    """Single zip file archive is streamed into instead of a folder tree.
+
+    Media is added as soon as each download completes, under media/<first two hex digits>/<sha256><ext>,
+    so equal content is kept once. Zip central directory lets any single file be extracted without
+    unpacking the rest; index/*.json members map media urls to members and record pages, and
+    are read back when bundle is opened again, so incremental runs append only new media and
+    changed pages. Later of same-named members is the current one.
+
+    Index is written every SAVE_EVERY members, and directory once, on close; a bundle left without
+    directory by an interrupted run is recovered on open, so at most the last SAVE_EVERY members
+    are lost. Directory lists current members only, so extracting bundle gives each file once;
+    superseded ones stay in the file until they take COMPACT_RATIO of it, then bundle is rewritten.
+    """
+
+    SAVE_EVERY = 100
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: zip file, created if missing and appended to otherwise
+        """
+        super().__init__()
+        self.path = path
+        self.incoming = path + '.incoming'
+        os.makedirs(self.incoming, exist_ok=True)
+        self.lock = threading.Lock()
+        self.unsaved = {}  # entries added since the last save
+        self.entries = {}  # url or page member -> dict(member, size, sha256, thumb)
+        if os.path.isfile(path):
+            try:
+                zipfile.ZipFile(path).close()
+            except zipfile.BadZipFile:  # directory is missing or partly overwritten by an interrupted run
+                recover(path)
+        self.zip = zipfile.ZipFile(path, 'a' if os.path.isfile(path) else 'w', zipfile.ZIP_DEFLATED)
+        indexes = sorted({n for n in self.zip.namelist() if n.startswith(INDEX_DIR)})
+        for name in indexes:
+            self.entries.update(json.loads(self.zip.read(name).decode('utf-8')))
+        self.saves = int(indexes[-1][len(INDEX_DIR):-len('.json')]) if indexes else 0
+        self.members = {entry['member'] for entry in self.entries.values()}
+
+    def get(self, url: str) -> Optional[Dict]:
+        """Entry of url or page member, None if it is not in bundle."""
+        with self.lock:
+            return self.entries.get(url)
+
+    def incoming_path(self, url: str) -> str:
+        """Where to download url to before adding it to bundle.
+
+        Path depends only on url, so interrupted download is found and resumed by the next run.
+        """
+        return os.path.join(self.incoming, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _write(self, member: str, path: str = None, data: bytes = None) -> None:
+        compress_type = zipfile.ZIP_STORED if os.path.splitext(member)[1].lower() in STORED_EXTENSIONS \
+            else zipfile.ZIP_DEFLATED
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # duplicate names are expected, the later one is current
+            if path is not None:
+                self.zip.write(path, member, compress_type)
+            else:
+                self.zip.writestr(member, data, compress_type)
+
+    def _put(self, key: str, entry: Dict) -> None:
+        self.entries[key] = self.unsaved[key] = entry
+        self.members.add(entry['member'])
+        if len(self.unsaved) >= self.SAVE_EVERY:
+            self._save()
+
+    def add(self, url: str, path: str, size: int, sha256: str, ext: str = '', keep: bool = False) -> str:
+        """Add downloaded file to bundle.
+
+        :param url: url file came from
+        :param path: downloaded file, removed unless keep is set
+        :param size: file size
+        :param sha256: hex digest of file
+        :param ext: extension of member, like '.jpg'
+        :param keep: leave file on disk, to make thumbnail of it
+        :return: member name
+        """
+        member = '{}{}/{}{}'.format(MEDIA_DIR, sha256[:2], sha256, ext)
+        with self.lock:
+            if member not in self.members:
+                self._write(member, path)
+            self._put(url, dict(member=member, size=size, sha256=sha256))
+        if not keep:
+            os.remove(path)
+        return member
+
+    def add_thumbnail(self, url: str, path: str) -> str:
+        """Add thumbnail of media at url, already in bundle, and remove the thumbnail file.
+
+        :return: member name
+        """
+        with self.lock:
+            entry = dict(self.entries[url])
+            entry['thumb'] = '{}{}/{}.jpg'.format(THUMBS_DIR, entry['sha256'][:2], entry['sha256'])
+            self._write(entry['thumb'], path)
+            self._put(url, entry)
+        os.remove(path)
+        return entry['thumb']
+
+    @contextmanager
+    def open_text(self, member: str) -> Iterator[TextIO]:
+        """Text file written into bundle member on exit, if its content changed since the last run."""
+        member = member.replace(os.sep, '/')
+        buffer = io.StringIO()
+        yield buffer
+        data = buffer.getvalue().encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if (self.entries.get(member) or {}).get('sha256') != sha256:
+                self._write(member, data=data)
+                self._put(member, dict(member=member, size=len(data), sha256=sha256))
+
+    def read(self, member: str) -> bytes:
+        """Content of one member."""
+        with self.lock:
+            return self.zip.read(member)
+
+    def _save(self, entries: Dict = None) -> None:
+        if entries or self.unsaved:
+            self.saves += 1
+            self._write('{}{:06d}.json'.format(INDEX_DIR, self.saves),
+                        data=json.dumps(entries or self.unsaved).encode('utf-8'))
+            self.unsaved = {}
+
+    def save(self) -> None:
+        """Write index of members added so far; directory is written on close."""
+        with self.lock:
+            self._save()
+
+    def close(self) -> None:
+        """Write index and directory of current members, compacting bundle if needed."""
+        with self.lock:
+            indexes = [info for info in self.zip.filelist if info.filename.startswith(INDEX_DIR)]
+            self._save(self.entries if len(indexes) + bool(self.unsaved) > 1 else None)  # one index is left
+            index = '{}{:06d}.json'.format(INDEX_DIR, self.saves)
+            current = [info for info in self.zip.filelist
+                       if self.zip.NameToInfo[info.filename] is info
+                       and (info.filename == index or not info.filename.startswith(INDEX_DIR))]
+            kept = set(map(id, current))
+            superseded = [info for info in self.zip.filelist if id(info) not in kept]
+            if superseded:
+                self.zip.filelist = current
+                self.zip.NameToInfo = {info.filename: info for info in current}
+                self.zip._didModify = True  # directory is written even if no member was added
+            self.zip.close()
+            if superseded:
+                with open(self.path, 'rb') as f:
+                    wasted = sum(member_span(f, info) for info in superseded)
+                if wasted > COMPACT_RATIO * os.path.getsize(self.path):
+                    compact(self.path, current)
+        if not os.listdir(self.incoming):
+            os.rmdir(self.incoming)
+
+    def names(self) -> List[str]:
+        """Names of all members."""
+        with self.lock:
+            return self.zip.namelist()
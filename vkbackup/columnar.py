@@ -0,0 +1,379 @@
+import json
+import mmap
+import os
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+FORMAT = 'vkbackup-columnar'
+VERSION = 2
+READABLE_VERSIONS = (1, 2)  # version 1 compressed every column file as a whole
+META = 'meta.json'
+
+# message fields kept as typed arrays, with array typecodes
+INT_COLUMNS = (('mid', 'q'), ('date', 'q'), ('uid', 'q'), ('from_id', 'q'), ('out', 'b'), ('read_state', 'b'))
+# field kept in a string heap
+STRING_COLUMN = 'body'
+# every other field, and fields of unexpected type, are kept as JSON in a side table
+REST_COLUMN = 'rest'
+# index of key order of every message in the key order table of meta.json
+KEYS_COLUMN = ('keys', 'i')
+
+INT_NAMES = frozenset(name for name, _ in INT_COLUMNS)
+LIMITS = {'q': (-2 ** 63, 2 ** 63 - 1), 'b': (-128, 127)}
+BLOCK = 4096  # messages buffered before writing columns out
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+class _ColumnFile:
+    """Column file written block by block.
+
+    Compressed blocks are independent zlib streams, and ends of every block in file and in
+    uncompressed data are recorded, so any part of column is read by inflating its blocks only.
+    """
+
+    def __init__(self, path: str, compress: bool) -> None:
+        self.f = open(path, 'wb')
+        self.compress = compress
+        self.pending = []
+        self.ends = []  # [end in file, end in uncompressed data] of every block
+        self.raw_end = 0
+
+    def write(self, data: bytes) -> None:
+        if self.compress:
+            self.pending.append(data)
+        else:
+            self.f.write(data)
+
+    def write_array(self, a: array) -> None:
+        if not LITTLE_ENDIAN:  # files are little-endian everywhere
+            a = array(a.typecode, a)
+            a.byteswap()
+        self.write(a.tobytes())
+
+    def end_block(self) -> None:
+        if not self.pending:
+            return
+        data = b''.join(self.pending)
+        self.pending = []
+        if data:
+            self.f.write(zlib.compress(data, 6))
+            self.raw_end += len(data)
+            self.ends.append([self.f.tell(), self.raw_end])
+
+    def close(self) -> None:
+        self.end_block()
+        self.f.close()
+
+
+def column_path(root: str, name: str) -> str:
+    return os.path.join(root, name + '.bin')
+
+
+def write(path: str, msgs: Iterable[Dict], compress: bool = True) -> int:
+    """Save messages as columnar archive.
+
+    Archive is a folder with a file per column: ids, dates, authors and flags as arrays of
+    little-endian integers; bodies as one utf-8 heap with an array of offsets; other fields
+    (attachments, forwarded messages and so on) as JSON heap with offsets. Key order of every
+    message is kept too, so messages are read back exactly as they were.
+    Messages are written as they come, in blocks, so memory use does not depend on their number.
+
+    :param path: archive folder, created if missing
+    :param msgs: messages, can be a generator
+    :param compress: zlib compress column files in blocks of BLOCK messages, a block is inflated
+                     only when read; uncompressed archives are larger, and are read without inflating
+    :return: number of written messages
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, META)
+    if os.path.exists(meta_path):  # archive without meta is incomplete, so it is not read while rewritten
+        os.remove(meta_path)
+    names = [name for name, _ in INT_COLUMNS] + [KEYS_COLUMN[0]]
+    for name in (STRING_COLUMN, REST_COLUMN):
+        names += [name, name + '.offsets']
+    files = {name: _ColumnFile(column_path(path, name), compress) for name in names}
+    key_orders = {}
+    heap_ends = {STRING_COLUMN: 0, REST_COLUMN: 0}
+
+    def new_block() -> Dict[str, array]:
+        block = {name: array(typecode) for name, typecode in INT_COLUMNS + (KEYS_COLUMN,)}
+        for name in heap_ends:
+            block[name + '.offsets'] = array('q')
+        return block
+
+    def flush(block: Dict[str, array], heaps: Dict[str, List[bytes]]) -> None:
+        for name, a in block.items():
+            files[name].write_array(a)
+        for name, pieces in heaps.items():
+            files[name].write(b''.join(pieces))
+        for f in files.values():
+            f.end_block()
+
+    n = 0
+    try:
+        for name in heap_ends:  # offsets start with 0, so string i is heap[offsets[i]:offsets[i + 1]]
+            files[name + '.offsets'].write_array(array('q', [0]))
+        block, heaps = new_block(), {name: [] for name in heap_ends}
+        for msg in msgs:
+            rest = {}
+            for name, typecode in INT_COLUMNS:
+                value = msg.get(name, 0)
+                low, high = LIMITS[typecode]
+                if type(value) is int and low <= value <= high:
+                    block[name].append(value)
+                else:
+                    block[name].append(0)
+                    rest[name] = value
+            body = msg.get(STRING_COLUMN, '')
+            if type(body) is not str:
+                rest[STRING_COLUMN] = body
+                body = ''
+            rest.update((k, v) for k, v in msg.items()
+                        if k not in rest and k != STRING_COLUMN and k not in INT_NAMES)
+            encoded = {STRING_COLUMN: body.encode('utf-8', 'surrogatepass'),
+                       REST_COLUMN: json.dumps(rest).encode('utf-8') if rest else b''}
+            for name, data in encoded.items():
+                heaps[name].append(data)
+                heap_ends[name] += len(data)
+                block[name + '.offsets'].append(heap_ends[name])
+            block[KEYS_COLUMN[0]].append(key_orders.setdefault(tuple(msg), len(key_orders)))
+            n += 1
+            if n % BLOCK == 0:
+                flush(block, heaps)
+                block, heaps = new_block(), {name: [] for name in heap_ends}
+        flush(block, heaps)
+    finally:
+        for f in files.values():
+            f.close()
+    meta = dict(format=FORMAT, version=VERSION, count=n, compression='zlib-blocks' if compress else None,
+                columns=dict(INT_COLUMNS + (KEYS_COLUMN,)), strings=[STRING_COLUMN, REST_COLUMN],
+                key_orders=[list(keys) for keys in key_orders])
+    if compress:
+        meta['blocks'] = {name: f.ends for name, f in files.items()}
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    return n
+
+
+class BlockFile:
+    """Uncompressed bytes of column file compressed in blocks, inflating only the blocks sliced."""
+
+    def __init__(self, data: Union[bytes, mmap.mmap], ends: List[List[int]]) -> None:
+        """
+        :param data: compressed file
+        :param ends: [end in file, end in uncompressed data] of every block, written by _ColumnFile
+        """
+        self.data = data
+        self.packed_ends = [0] + [packed for packed, _ in ends]
+        self.raw_ends = [0] + [raw for _, raw in ends]
+        self.cached = (None, b'')  # the last block inflated, reads are mostly sequential
+
+    def __len__(self) -> int:
+        return self.raw_ends[-1]
+
+    def block(self, k: int) -> bytes:
+        number, data = self.cached
+        if number != k:
+            data = zlib.decompress(self.data[self.packed_ends[k]:self.packed_ends[k + 1]])
+            self.cached = (k, data)
+        return data
+
+    def __getitem__(self, s: slice) -> bytes:
+        start, stop, _ = s.indices(len(self))
+        pieces = []
+        k = bisect_right(self.raw_ends, start) - 1
+        while start < stop:
+            base = self.raw_ends[k]
+            block = self.block(k)
+            pieces.append(block[start - base:stop - base])
+            start = base + len(block)
+            k += 1
+        return b''.join(pieces)
+
+    def blocks(self) -> Iterator[bytes]:
+        for k in range(len(self.raw_ends) - 1):
+            yield self.block(k)
+
+
+class BlockArray:
+    """Integers of column compressed in blocks, see BlockFile."""
+
+    def __init__(self, file: BlockFile, typecode: str) -> None:
+        self.file = file
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+
+    def __len__(self) -> int:
+        return len(self.file) // self.itemsize
+
+    def _array(self, data: bytes) -> array:
+        values = array(self.typecode)
+        values.frombytes(data)
+        if not LITTLE_ENDIAN:
+            values.byteswap()
+        return values
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[int, array]:
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            values = self._array(self.file[start * self.itemsize:max(stop, start) * self.itemsize])
+            return values if step == 1 else values[::step]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('column index out of range')
+        return int.from_bytes(self.file[i * self.itemsize:(i + 1) * self.itemsize], 'little', signed=True)
+
+    def __iter__(self) -> Iterator[int]:
+        for block in self.file.blocks():  # blocks hold whole values
+            yield from self._array(block)
+
+
+class StringColumn:
+    """Strings of a column, decoded only when accessed."""
+
+    def __init__(self, heap: Union[bytes, mmap.mmap, BlockFile], offsets: Sequence[int]) -> None:
+        self.heap = heap
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.heap[self.offsets[i]:self.offsets[i + 1]].decode('utf-8', 'surrogatepass')
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ColumnarArchive:
+    """Reader of archive saved by write.
+
+    Columns are read one by one when first asked for, so stats over one field never touch
+    the others and no message dicts are built. Column files are memory-mapped; compressed
+    ones are inflated a block at a time as values are read, so a single message or a pass
+    over one column keeps at most a block of it in memory. Sequences returned for columns
+    are valid until archive is closed.
+
+    Example::
+
+        with ColumnarArchive('Pavel Durov.vkcol') as a:
+            dates = a.column('date')
+            last_year = [i for i, date in enumerate(dates) if date >= 1483228800]
+            msgs = [a.message(i) for i in last_year]
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: archive folder
+        """
+        self.path = path
+        with open(os.path.join(path, META), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT or self.meta.get('version') not in READABLE_VERSIONS:
+            raise ValueError('{} is not a columnar archive of version {}'.format(path, VERSION))
+        self.key_orders = [tuple(keys) for keys in self.meta['key_orders']]
+        self.columns = {}
+        self.maps = []
+        self.views = []
+
+    def __len__(self) -> int:
+        return self.meta['count']
+
+    def __enter__(self) -> 'ColumnarArchive':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _read(self, name: str) -> Union[bytes, mmap.mmap, BlockFile]:
+        with open(column_path(self.path, name), 'rb') as f:
+            if self.meta['compression'] == 'zlib':
+                return zlib.decompress(f.read())
+            if os.fstat(f.fileno()).st_size == 0:  # empty files can not be mapped
+                data = b''
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps.append(data)
+        if self.meta['compression'] == 'zlib-blocks':
+            return BlockFile(data, self.meta['blocks'][name])
+        return data
+
+    def _int_column(self, name: str, typecode: str) -> Sequence[int]:
+        data = self._read(name)
+        if isinstance(data, BlockFile):
+            return BlockArray(data, typecode)
+        if isinstance(data, mmap.mmap) and LITTLE_ENDIAN:
+            view = memoryview(data)
+            self.views.append(view)
+            values = view.cast(typecode)
+            self.views.append(values)
+            return values
+        values = array(typecode)
+        values.frombytes(data)
+        if not LITTLE_ENDIAN:
+            values.byteswap()
+        return values
+
+    def column(self, name: str) -> Union[Sequence[int], StringColumn]:
+        """Values of one field for all messages, in order.
+
+        :param name: one of mid, date, uid, from_id, out, read_state (sequence of ints), body or rest
+                     (sequence of strings, rest is JSON of other fields or empty string)
+        :return: sequence of values; integer fields are 0 where message had no such field or kept
+                 it in rest
+        """
+        if name not in self.columns:
+            typecode = self.meta['columns'].get(name)
+            if typecode is not None:
+                self.columns[name] = self._int_column(name, typecode)
+            elif name in self.meta['strings']:
+                self.columns[name] = StringColumn(self._read(name), self._int_column(name + '.offsets', 'q'))
+            else:
+                raise KeyError(name)
+        return self.columns[name]
+
+    def message(self, i: int) -> Dict:
+        """Message number i, exactly as it was written."""
+        rest = self.column(REST_COLUMN)[i]
+        rest = json.loads(rest) if rest else {}
+        msg = {}
+        for key in self.key_orders[self.column(KEYS_COLUMN[0])[i]]:
+            if key in rest:
+                msg[key] = rest[key]
+            elif key == STRING_COLUMN:
+                msg[key] = self.column(STRING_COLUMN)[i]
+            else:
+                msg[key] = self.column(key)[i]
+        return msg
+
+    def messages(self, indices: Optional[Iterable[int]] = None) -> Iterator[Dict]:
+        """Messages in order, or those at given indices.
+
+        json.dumps(list(archive.messages())) is the same as json.dumps of written messages.
+        """
+        for i in range(len(self)) if indices is None else indices:
+            yield self.message(i)
+
+    def close(self) -> None:
+        self.columns.clear()
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        for data in self.maps:
+            try:
+                data.close()
+            except BufferError:  # caller still holds a slice of a column, map is freed with it
+                pass
+        self.maps = []
+
+
+def load(path: str) -> Iterator[Dict]:
+    """Messages of columnar archive at path, in order."""
+    with ColumnarArchive(path) as a:
+        yield from a.messages()
@@ -0,0 +1,151 @@
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from vkbackup.metrics import metrics
+
+# validators kept for conditional requests, and response headers they come from
+VALIDATORS = (('etag', 'ETag'), ('last_modified', 'Last-Modified'))
+
+OnDone = Callable[[str, str, str, Dict[str, str]], None]
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """Session keeping up to pool_size connections per host alive."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Downloader:
+    """Concurrent file downloader sharing pooled connections between workers."""
+
+    def __init__(self, workers: int = 8, chunk_size: int = 256 * 1024, timeout: float = 60,
+                 session: requests.Session = None) -> None:
+        """
+        :param workers: number of parallel downloads
+        :param chunk_size: bytes read from response at once
+        :param timeout: connect and read timeout in seconds
+        :param session: session to use, by default one with connection pool of workers size is made
+        """
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = session or make_session(workers)
+        self.pool = ThreadPoolExecutor(workers)  # shared by concurrent download calls
+
+    def download(self, jobs: List[Tuple[str, str]], desc: str = 'Downloading media',
+                 on_done: OnDone = None, validators: Dict[str, Dict] = None) -> int:
+        """Download files, showing one progress bar for all of them.
+
+        Failed downloads are reported and skipped.
+
+        :param jobs: list of (url, path to save to)
+        :param desc: progress bar title
+        :param on_done: called from worker thread as on_done(url, path, sha256, validators) after each
+                        complete download, see fetch
+        :param validators: url -> validators of copy downloaded before, for conditional requests, see fetch
+        :return: number of downloaded bytes
+        """
+        total_bytes = 0
+        failed = 0
+        validators = validators or {}
+        with tqdm(desc=desc, unit='file', total=len(jobs)) as progress:
+            futures = {self.pool.submit(self.fetch, url, path, on_done, validators.get(url)): url
+                       for url, path in jobs}
+            for future in as_completed(futures):
+                try:
+                    total_bytes += future.result()
+                    metrics.count('download.files')
+                except (requests.RequestException, OSError) as e:
+                    failed += 1
+                    metrics.count('download.failed')
+                    tqdm.write('Failed to download {}: {}'.format(futures[future], e))
+                progress.update(1)
+                progress.set_postfix(mb='{:.1f}'.format(total_bytes / 2 ** 20), failed=failed)
+        return total_bytes
+
+    def submit(self, url: str, path: str, on_done: OnDone = None, validators: Dict = None) -> Future:
+        """Start downloading one file in background, see fetch.
+
+        :return: future of number of downloaded bytes, it raises if download failed
+        """
+        return self.pool.submit(self.fetch, url, path, on_done, validators)
+
+    def fetch(self, url: str, path: str, on_done: OnDone = None, validators: Dict = None) -> int:
+        """Download one file.
+
+        Data goes to a temporary .part file which is renamed to path only when complete.
+        Download of existing .part file is resumed with Range request.
+
+        With validators of a copy downloaded before, the request is conditional: file is downloaded
+        only if server says it changed since, by ETag or Last-Modified, or by Content-Length of HEAD
+        response when server gave neither.
+
+        :param url: file url
+        :param path: path to save to
+        :param on_done: called as on_done(url, path, sha256, validators) when file is complete,
+                        validators are etag and last_modified of response, to store for the next runs
+        :param validators: dict with etag, last_modified and size of copy downloaded before
+        :return: number of downloaded bytes, 0 if file did not change
+        """
+        part = path + '.part'
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        if validators and not offset:
+            headers = conditional_headers(validators)
+            if not headers and validators.get('size') is not None:
+                with self.session.head(url, timeout=self.timeout, allow_redirects=True) as resp:
+                    if resp.ok and resp.headers.get('Content-Length') == str(validators['size']):
+                        metrics.count('download.not_modified')
+                        return 0
+        digest = hashlib.sha256()
+        size = 0
+        with metrics.timer('download.file'), \
+                self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as resp:
+            if resp.status_code == 416:  # part is bigger than file now is, start over
+                os.remove(part)
+                return self.fetch(url, path, on_done)
+            if resp.status_code == 304:
+                metrics.count('download.not_modified')
+                return 0
+            resp.raise_for_status()
+            received = {key: resp.headers[header] for key, header in VALIDATORS if header in resp.headers}
+            if resp.status_code == 206:
+                metrics.count('download.resumed')
+                with open(part, 'rb') as f:
+                    for data in iter(lambda: f.read(self.chunk_size), b''):
+                        digest.update(data)
+            else:
+                offset = 0
+            length = resp.headers.get('Content-Length')
+            expected = offset + int(length) if length and 'Content-Encoding' not in resp.headers else None
+            with open(part, 'ab' if offset else 'wb') as f:
+                for data in resp.iter_content(self.chunk_size):
+                    f.write(data)
+                    digest.update(data)
+                    size += len(data)
+            metrics.count('download.bytes', size)
+        if expected is not None and offset + size != expected:
+            raise IOError('connection closed after {} of {} bytes'.format(offset + size, expected))
+        os.replace(part, path)
+        if on_done is not None:
+            on_done(url, path, digest.hexdigest(), received)
+        return size
+
+
+def conditional_headers(validators: Dict) -> Dict[str, str]:
+    """Headers asking server to send file only if it changed since copy with validators was downloaded."""
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
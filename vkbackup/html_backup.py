@@ -1,17 +1,93 @@
 from datetime import datetime
 import os
-from jinja2 import Environment, PackageLoader, select_autoescape
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape
 
-from typing import List, Dict
+from typing import Callable, List, Dict, Iterable, Iterator, Optional, TextIO, Tuple
 
+from vkbackup import parallel
+from vkbackup.metrics import metrics
 
-def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
+WRITE_BUFFER = 2 ** 20  # bytes buffered by html files
+
+
+def bytecode_cache() -> FileSystemBytecodeCache:
+    """Cache of compiled templates shared by all runs, in user cache folder or in temp folder if it is not writable."""
+    directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+                             'vkbackup', 'jinja')
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        directory = None
+    return FileSystemBytecodeCache(directory)
+
+
+class DictEnvironment(Environment):
+    """Environment looking up ``obj.attr`` as item first.
+
+    Templates are filled with dicts, and jinja tries attribute first, so every ``msg.date`` raised
+    and caught AttributeError; that took most of rendering time.
+    """
+
+    def getattr(self, obj, attribute):
+        try:
+            return obj[attribute]
+        except (TypeError, LookupError):
+            return super().getattr(obj, attribute)
+
+
+# templates are compiled once per process, and loaded from bytecode cache by the next processes
+env = DictEnvironment(
+    loader=PackageLoader('vkbackup', 'templates'),
+    autoescape=select_autoescape(['html']),
+    bytecode_cache=bytecode_cache(),
+    auto_reload=False,
+)
+
+
+Media = Dict[str, Dict[str, str]]  # url -> dict(file=local file, thumb=local thumbnail), relative links
+
+
+def with_media(obj: Dict, url: str, media: Media = None) -> Dict:
+    """Add links to local copy and thumbnail of url to attachment dict, if there are any."""
+    local = media.get(url) if media and url else None
+    return dict(obj, **local) if local else obj
+
+
+class PrefixedMedia:
+    """Media links seen from a subfolder, looked up in media when needed, so media can be filled while rendering."""
+
+    def __init__(self, media: Media, prefix: str) -> None:
+        self.media = media
+        self.prefix = prefix
+
+    def get(self, url: str) -> Dict[str, str]:
+        local = self.media.get(url)
+        return {kind: self.prefix + link for kind, link in local.items()} if local else None
+
+
+def html_repr(msgs: List[Dict], participants: Dict, media: Media = None, processes: int = 1) -> List[Dict]:
     """Html representation of conversation.
 
     :param msgs: messages list
     :param participants: participants dict
+    :param media: local copies of media, see iter_html_repr
+    :param processes: number of processes converting chunks of messages, None for one per cpu core
     :return: list of dicts with parameters to fill template
     """
+    if processes != 1:
+        return list(parallel.imap_chunks(iter_html_repr, msgs, (participants, media), processes))
+    return list(iter_html_repr(msgs, participants, media))
+
+
+def iter_html_repr(msgs: Iterable[Dict], participants: Dict, media: Media = None) -> Iterator[Dict]:
+    """Html representation of conversation, made lazily message by message.
+
+    :param msgs: messages, can be a generator
+    :param participants: participants dict
+    :param media: local copies of media by url, templates prefer them to remote urls;
+                  photos are looked up by the url of the biggest size
+    :return: generator of dicts with parameters to fill template
+    """
 
     def audio_to_dict(audio) -> Dict:
         """Dict representation of audio attachment.
@@ -19,13 +95,13 @@ def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
         :param audio: attachment of type audio
         :returns: dict with audio info
         """
-        return dict(
+        return with_media(dict(
             type='audio',
             artist=audio.get('artist') or audio.get('performer', None),
             title=audio.get('title', None),
             content_restricted='content_restricted' in audio,
             url=audio.get('url', None)
-        )
+        ), audio.get('url', None), media)
 
     def photo_to_dict(photo) -> Dict:
         """Dict representation of photo attachment.
@@ -33,7 +109,10 @@ def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
         :param photo: attachment of type photo
         :returns: dict with photo info
         """
-        return dict(
+        biggest = photo.get('src_xxxbig', None) or photo.get('src_xxbig', None) or \
+            photo.get('src_xbig', None) or photo.get('src_big', None) or \
+            photo.get('src', None) or photo.get('src_small', None)
+        return with_media(dict(
             type='photo',
             src_big=photo.get('src_big', None),
             src_small=photo.get('src_small', None),
@@ -41,10 +120,8 @@ def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
             src_xbig=photo.get('src_xbig', None),
             src_xxbig=photo.get('src_xxbig', None),
             src_xxxbig=photo.get('src_xxxbig', None),
-            biggest=photo.get('src_xxxbig', None) or photo.get('src_xxbig', None) or
-            photo.get('src_xbig', None) or photo.get('src_big', None) or
-            photo.get('src', None) or photo.get('src_small', None)
-        )
+            biggest=biggest
+        ), biggest, media)
 
     def sticker_to_dict(sticker) -> Dict:
         """Dict representation of sticker.
@@ -52,14 +129,14 @@ def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
         :param sticker: attachment of type sticker
         :returns: dict with sticker info
         """
-        return dict(
+        return with_media(dict(
             type='sticker',
             photo_256=sticker.get('photo_256', None),  # preferable
             photo_352=sticker.get('photo_352', None),
             photo_512=sticker.get('photo_512', None),
             photo_128=sticker.get('photo_128', None),
             photo_64=sticker.get('photo_64', None),
-        )
+        ), sticker.get('photo_128', None), media)
 
     def doc_to_dict(doc) -> Dict:
         """Dict representation of attached document.
@@ -81,11 +158,11 @@ def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
         :param video: attachment of type video
         :returns: dict with video info
         """
-        return dict(
+        return with_media(dict(
             type='video',
             image=video.get('image', None),
             title=video.get('title', None)
-        )
+        ), video.get('image', None), media)
 
     def link_to_dict(link) -> Dict:
         """Dict representation of attached link.
@@ -155,20 +232,129 @@ def html_repr(msgs: List[Dict], participants: Dict) -> List[Dict]:
             is_out='out' in msg and msg['out']
         )
 
-    return [to_dialogue(msg) for msg in msgs]
-
-
-def render(path, peer_id, msgs, participants, audio, photo):
-    env = Environment(
-        loader=PackageLoader('vkbackup', 'templates'),
-        autoescape=select_autoescape(['html'])
-    )
-    messages = env.get_template('layout.html')
-    html = messages.render(msgs=html_repr(msgs, participants),
-                           peer=peer_id,
-                           participants=participants,
-                           audios=audio,
-                           photos=photo,
-                           )
-    with open(os.path.join(path, '{}.{}'.format(peer_id, 'html')), 'w', encoding='utf-8') as f:
-        f.write(html)
+    for msg in msgs:
+        yield to_dialogue(msg)
+
+
+def paginate(msgs: Iterable[Dict], page_by: str = 'month', page_size: int = 1000) -> Iterator[Tuple[str, List[Dict]]]:
+    """Split conversation into pages.
+
+    :param msgs: messages, can be a generator
+    :param page_by: 'month' for page per calendar month, 'count' for pages of page_size messages
+    :param page_size: messages per page when paginating by count
+    :return: generator of (page name, messages of page)
+    """
+    if page_by == 'month':
+        def page_key(i, msg):
+            return str(datetime.fromtimestamp(msg['date']))[:7]  # same as month of html representation
+    elif page_by == 'count':
+        def page_key(i, msg):
+            return '{:05d}'.format(i // page_size + 1)
+    else:
+        raise ValueError('unknown pagination: {}'.format(page_by))
+
+    page, name = [], None
+    for i, msg in enumerate(msgs):
+        key = page_key(i, msg)
+        if key != name and page:
+            yield name, page
+            page = []
+        name = key
+        page.append(msg)
+    if page:
+        yield name, page
+
+
+def write_file(file: str) -> TextIO:
+    """Open html file for writing."""
+    return open(file, 'w', encoding='utf-8', buffering=WRITE_BUFFER)
+
+
+def write_page(path: str, peer_id: str, name: str, msgs: List[Dict], prev: Optional[str], next: Optional[str],
+               participants: Dict, media: Media = None, open_file: Callable[[str], TextIO] = write_file) -> Dict:
+    """Render one page of conversation, see render.
+
+    :param prev: name of previous page, if any
+    :param next: name of next page, if any
+    :return: entry of page in index
+    """
+    pages_dir = '{}_pages'.format(peer_id)
+    rows = list(iter_html_repr(msgs, participants, media))
+    with open_file(os.path.join(path, pages_dir, name + '.html')) as f, metrics.timer('render.page'):
+        f.writelines(env.get_template('page.html').generate(msgs=rows,
+                                                            peer=peer_id,
+                                                            page=name,
+                                                            index='../{}.html'.format(peer_id),
+                                                            prev=prev + '.html' if prev else None,
+                                                            next=next + '.html' if next else None,
+                                                            ))
+    return dict(name=name,
+                href='{}/{}.html'.format(pages_dir, name),
+                first=rows[0]['date'],
+                last=rows[-1]['date'],
+                count=len(rows))
+
+
+def _write_page(page: Tuple[str, List[Dict], Optional[str], Optional[str]], path: str, peer_id: str,
+                participants: Dict, media: Media) -> Dict:
+    return write_page(path, peer_id, *page, participants, media)
+
+
+def render(path, peer_id, msgs, participants, audio, photo, page_by='month', page_size=1000, media=None,
+           open_file=None, processes=1):
+    """Render conversation into paginated html.
+
+    <peer_id>.html is an index with links to pages, photos and audios; pages are kept in
+    <peer_id>_pages folder. Messages are rendered page by page, so only one page is held in memory,
+    or a few pages per process when pages are rendered in worker processes.
+
+    :param path: folder to render to
+    :param peer_id: id or screen name of peer
+    :param msgs: messages, can be a generator
+    :param participants: participants dict
+    :param audio: audio objects made by vk_msg.audio_links
+    :param photo: photo objects made by vk_msg.photo_links
+    :param page_by: 'month' or 'count', see paginate
+    :param page_size: messages per page when paginating by count
+    :param media: local copies of media by url, links relative to path; html refers to them instead of vk.com
+                  (media can be added while msgs are consumed, messages are rendered with media known by then)
+    :param open_file: opens file at given path for writing text, like bundle.Bundle.open_text;
+                      by default files are written to disk
+    :param processes: number of processes rendering pages, None for one per cpu core; pages are rendered
+                      in calling process when open_file is given, and must be when media is filled while rendering
+    """
+    pages_dir = '{}_pages'.format(peer_id)
+    if open_file is None:
+        os.makedirs(os.path.join(path, pages_dir), exist_ok=True)
+        open_file = write_file
+    page_media = PrefixedMedia(media, '../') if media is not None else None  # pages are one folder deeper
+
+    def jobs():
+        held, prev = None, None  # page is written when name of the next one is known
+        for name, page in paginate(msgs, page_by, page_size):
+            if held is not None:
+                yield held[0], held[1], prev, name
+                prev = held[0]
+            held = name, page
+        if held is not None:
+            yield held[0], held[1], prev, None
+
+    if processes == 1 or open_file is not write_file:
+        written = (write_page(path, peer_id, *job, participants, page_media, open_file) for job in jobs())
+    else:
+        written = parallel.imap(_write_page, jobs(), (path, peer_id, participants, page_media), processes)
+    pages = []
+    for page in written:
+        metrics.count('render.pages')
+        metrics.count('render.messages', page['count'])
+        pages.append(page)
+
+    with open_file(os.path.join(path, '{}.{}'.format(peer_id, 'html'))) as f, metrics.timer('render.index'):
+        f.writelines(env.get_template('layout.html').generate(
+            pages=pages,
+            total=sum(p['count'] for p in pages),
+            peer=peer_id,
+            participants=participants,
+            audios=[with_media(a, a.get('url'), media) for a in audio],
+            photos=[with_media(p, p['biggest'], media) for p in photo],
+        ))
@@ -0,0 +1,82 @@
+import json
+from typing import Dict, Iterable, Iterator, TextIO
+
+SEPARATORS = frozenset(' \t\r\n,')  # between messages of array and of lines
+
+
+def dump_array(msgs: Iterable[Dict], f: TextIO) -> int:
+    """Write messages as JSON array one by one.
+
+    Output is the same as of ``f.write(json.dumps(list(msgs)))``, but the list is never built.
+
+    :param msgs: messages, can be a generator
+    :param f: text file opened for writing
+    :return: number of written messages
+    """
+    n = 0
+    f.write('[')
+    for msg in msgs:
+        if n:
+            f.write(', ')
+        f.write(json.dumps(msg))
+        n += 1
+    f.write(']')
+    return n
+
+
+def dump_lines(msgs: Iterable[Dict], f: TextIO) -> int:
+    """Write messages as JSON Lines, one message per line.
+
+    :param msgs: messages, can be a generator
+    :param f: text file opened for writing
+    :return: number of written messages
+    """
+    n = 0
+    for msg in msgs:
+        f.write(json.dumps(msg))
+        f.write('\n')
+        n += 1
+    return n
+
+
+def load(f: TextIO, block: int = 2 ** 20) -> Iterator[Dict]:
+    """Read messages written by dump_array or dump_lines one by one.
+
+    File is read in blocks, so memory use does not depend on the number of messages.
+
+    :param f: text file opened for reading
+    :param block: characters read at once
+    :return: generator of messages
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    array = None
+    while True:
+        while pos < len(buffer) and buffer[pos] in SEPARATORS:
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                return
+            buffer, pos = f.read(block), 0
+            eof = not buffer
+            continue
+        if array is None:  # array starts with bracket, lines with the first message
+            array = buffer[pos] == '['
+            if array:
+                pos += 1
+                continue
+        if array and buffer[pos] == ']':
+            return
+        try:
+            msg, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            data = f.read(block)  # message is split between blocks
+            eof = not data
+            buffer, pos = buffer[pos:] + data, 0
+            continue
+        yield msg
+        pos = end
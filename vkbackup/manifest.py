@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+
+class Manifest:
+    """Record of downloaded media kept next to the archive.
+
+    Maps url to local path (relative to archive root), size and sha256 of the file, so reruns
+    can tell downloaded, partial and missing files apart without touching the network.
+    """
+
+    FILENAME = 'manifest.json'
+    SAVE_EVERY = 50  # entries changed between saves, so interrupted runs keep most of their progress
+
+    def __init__(self, root: str) -> None:
+        """
+        :param root: archive root, manifest file is kept there
+        """
+        self.root = root
+        self.path = os.path.join(root, self.FILENAME)
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def get(self, url: str) -> Optional[Dict]:
+        """Entry of url or None."""
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url: str, path: str, size: Optional[int], sha256: Optional[str] = None, **extra) -> None:
+        """Record file of url.
+
+        :param url: media url
+        :param path: local path
+        :param size: expected file size, None if unknown
+        :param sha256: hex digest, None while download is not complete
+        :param extra: other values to keep in entry
+        """
+        entry = dict(path=os.path.relpath(path, self.root), size=size, sha256=sha256, **extra)
+        with self.lock:
+            self.entries[url] = entry
+            self.unsaved += 1
+            if self.unsaved < self.SAVE_EVERY:
+                return
+        self.save()
+
+    def local_path(self, url: str) -> Optional[str]:
+        """Path of fully downloaded file of url, None if it is missing or incomplete."""
+        entry = self.get(url)
+        if entry is None or entry['sha256'] is None:
+            return None
+        path = os.path.join(self.root, entry['path'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            return None
+        return path
+
+    def save(self) -> None:
+        """Write manifest file atomically."""
+        with self.lock:
+            data = json.dumps(self.entries, ensure_ascii=False)
+            self.unsaved = 0
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
@@ -0,0 +1,141 @@
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # not available on windows, peak memory is not reported there
+    resource = None
+
+# upper bounds of histogram buckets, in seconds for timers
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Count, sum, min, max and bucket counts of observed values."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last one is for values above all bounds
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+
+    def to_dict(self) -> Dict:
+        return dict(count=self.count, total=self.total, min=self.min, max=self.max,
+                    mean=self.total / self.count if self.count else None,
+                    buckets={('le_{}'.format(bound) if i < len(BUCKETS) else 'inf'): n
+                             for i, (bound, n) in enumerate(zip(BUCKETS + (None,), self.buckets)) if n})
+
+
+class Metrics:
+    """Counters and histograms of a run, safe to update from any thread.
+
+    Names are dotted, like 'api.calls.messages.getHistory' or 'download.bytes'.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add n to counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float) -> None:
+        """Add value to histogram."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Observe seconds spent in with block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def report(self) -> Dict:
+        """Everything measured so far, with wall time and peak memory of the process."""
+        with self.lock:
+            return dict(started=self.started,
+                        wall=time.time() - self.started,
+                        peak_rss_mb=peak_rss_mb(),
+                        peak_rss_children_mb=peak_rss_mb(children=True),
+                        counters=dict(sorted(self.counters.items())),
+                        histograms={name: h.to_dict() for name, h in sorted(self.histograms.items())})
+
+    def write_report(self, path: str) -> None:
+        """Write report as JSON file."""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def peak_rss_mb(children: bool = False) -> Optional[float]:
+    """Peak resident memory of process, or of its finished child processes, in megabytes."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)  # bytes on mac, kilobytes elsewhere
+
+
+# metrics of this run, updated by every stage
+metrics = Metrics()
+
+
+class Profiler:
+    """cProfile or pyinstrument profiler of the main thread."""
+
+    def __init__(self, kind: str = 'cprofile') -> None:
+        """
+        :param kind: 'cprofile' or 'pyinstrument', the latter has to be installed
+        """
+        self.kind = kind
+        if kind == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+        elif kind == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler as PyinstrumentProfiler
+            except ImportError:
+                raise RuntimeError('pyinstrument is not installed (pip install pyinstrument)')
+            self.profiler = PyinstrumentProfiler()
+        else:
+            raise ValueError('unknown profiler: {}'.format(kind))
+
+    def start(self) -> None:
+        if self.kind == 'cprofile':
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self, path: str) -> None:
+        """Stop profiling and save results.
+
+        :param path: cProfile stats file readable by pstats and snakeviz, or pyinstrument html page
+        """
+        if self.kind == 'cprofile':
+            self.profiler.disable()
+            self.profiler.dump_stats(path)
+        else:
+            self.profiler.stop()
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.profiler.output_html())
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+CHUNK = 2000  # messages converted by a worker at once
+
+_job = {}  # function and arguments of conversion, set in every worker process
+
+
+def _start(func: Callable, args: Tuple) -> None:
+    _job.update(func=func, args=args)
+
+
+def _call(item: Any) -> Any:
+    return _job['func'](item, *_job['args'])
+
+
+def imap(func: Callable, items: Iterable, args: Tuple = (), processes: int = None) -> Iterator[Any]:
+    """Same as ``(func(item, *args) for item in items)``, computed in worker processes.
+
+    Arguments are sent to every worker once, items as they are read; only a few items per worker
+    are in flight, so items can be a long generator. With a single item, or a single process,
+    everything is computed in calling process, starting workers would take longer.
+    Workers are spawned rather than forked, forking a process with running threads is unsafe.
+
+    :param func: module-level function
+    :param items: items to call func with, they must be picklable, as results must
+    :param args: other arguments of func, they must be picklable
+    :param processes: number of worker processes, cpu count by default
+    :return: generator of results, in order of items
+    """
+    processes = processes or os.cpu_count() or 1
+    items = iter(items)
+    first = list(islice(items, 2))
+    if processes == 1 or len(first) < 2:
+        for item in chain(first, items):
+            yield func(item, *args)
+        return
+    with ProcessPoolExecutor(processes, multiprocessing.get_context('spawn'), _start, (func, args)) as pool:
+        window = deque()
+        for item in chain(first, items):
+            window.append(pool.submit(_call, item))
+            if len(window) >= 2 * processes:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def convert_chunk(msgs: List[Dict], func: Callable[..., Iterable], *args) -> List[Any]:
+    return list(func(msgs, *args))
+
+
+def imap_chunks(func: Callable[..., Iterable], msgs: Iterable[Dict], args: Tuple = (), processes: int = None,
+                chunk_size: int = CHUNK) -> Iterator[Any]:
+    """Same as ``func(msgs, *args)`` for functions like vk_msg.iter_text making one item per message,
+    with messages split into chunks converted in worker processes and results merged in order.
+
+    :param func: module-level function taking messages and args and returning iterable of items
+    :param msgs: messages, can be a generator
+    :param args: other arguments of func, they must be picklable
+    :param processes: number of worker processes, cpu count by default
+    :param chunk_size: messages sent to a worker at once
+    :return: generator of items
+    """
+    msgs = iter(msgs)
+    chunks = iter(lambda: list(islice(msgs, chunk_size)), [])
+    for items in imap(convert_chunk, chunks, (func,) + tuple(args), processes):
+        yield from items
@@ -0,0 +1,193 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Dict, Iterator, List, Union
+from urllib.parse import quote
+
+import requests
+from tqdm import tqdm
+
+from vkbackup import archive, html_backup, vk_msg
+from vkbackup.blobs import BlobStore
+from vkbackup.downloader import Downloader
+from vkbackup.metrics import metrics
+from vkbackup.store import MessageStore, peer_key
+from vkbackup.thumbnails import Thumbnailer
+
+STORED_BATCH = 1000  # messages already in store are handled in batches of this size
+DONE = object()  # end of batches in queue
+
+
+class Batch:
+    """Messages of one fetched batch with downloads and user lookup started for them."""
+
+    def __init__(self, msgs: List[Dict], audio: List[Dict], photo: List[Dict], files: Dict[str, List[str]],
+                 sources: Dict[str, str], downloads: List[Future], claimed: List[str], users: Future) -> None:
+        self.msgs = msgs
+        self.audio = audio
+        self.photo = photo
+        self.files = files  # url -> local paths of media first seen in this batch
+        self.sources = sources  # url of files -> url they are downloaded from, see archive.download_plan
+        self.downloads = downloads
+        self.claimed = claimed
+        self.users = users
+
+
+def archive_peer(path: str, m: vk_msg.VkMessages, store: MessageStore, peer_id: Union[str, int], name: str,
+                 is_chat: bool = False, downloader: Downloader = None, blobs: BlobStore = None,
+                 thumbnailer: Thumbnailer = None, page_by: str = 'month', page_size: int = 1000,
+                 photo_size: str = 'original', revalidate: bool = False,
+                 originals: Dict[str, List[str]] = None) -> Dict:
+    """Sync conversation and archive it as archive.make does, with all stages running at the same time.
+
+    A producer thread syncs history; as each batch arrives its media are queued to download
+    workers and its users are resolved in background, while the calling thread renders html
+    of earlier batches. Messages already stored are handled first, so their media downloads
+    start before the first request to api. A batch is rendered once its media are downloaded,
+    so html refers to local files as archive.make does, and run takes about as long as the
+    slowest stage instead of the sum of all of them.
+
+    :param path: archive root
+    :param m: VkMessages instance
+    :param store: local message store
+    :param peer_id: id or screen name of user, or chat_id
+    :param name: name of peer folder
+    :param is_chat: if True, peer_id is treated as chat_id
+    :param downloader: media downloader, shared between peers archived at the same time
+    :param blobs: media store, shared between peers archived at the same time
+    :param thumbnailer: makes thumbnails of photos, None to link originals only
+    :param page_by: 'month' or 'count', see html_backup.paginate
+    :param page_size: messages per page when paginating by count
+    :param photo_size: size tier of photos to download, see archive.download_plan
+    :param revalidate: if True, stored media are downloaded again if they changed, see archive.download_plan
+    :param originals: dict filled with original photos to fetch later by archive.fetch_originals
+    :return: summary dict with counts of messages, participants, audios, photos and time spent fetching
+    """
+    started = time.time()
+    peer_path = os.path.join(path, name)
+    thumb_path = os.path.join(peer_path, 'thumbs')
+    for folder in [os.path.join(peer_path, folder) for folder in archive.MEDIA_FOLDERS] + [thumb_path]:
+        os.makedirs(folder, exist_ok=True)
+    downloader = downloader or Downloader()
+    blobs = blobs or BlobStore(path)
+    key = peer_key(peer_id if is_chat else m.get_user(str(peer_id))['uid'], is_chat)
+    last = store.last_mid(key)
+
+    batches = queue.Queue()
+    stop = threading.Event()
+    taken = set()  # local paths given to media of earlier batches
+    futures = []
+    summary = dict(messages=0)
+    progress = tqdm(desc='Downloading media', unit='file', total=0)
+    users = ThreadPoolExecutor(1)
+
+    def downloaded(url: str, future: Future) -> None:
+        if future.cancelled():
+            return
+        try:
+            future.result()
+            metrics.count('download.files')
+        except (requests.RequestException, OSError) as e:
+            metrics.count('download.failed')
+            tqdm.write('Failed to download {}: {}'.format(url, e))
+        progress.update(1)
+
+    def prepare(msgs: List[Dict]) -> Batch:
+        index = vk_msg.index_attachments(msgs)
+        audio = vk_msg.audio_links(msgs, index)
+        photo = vk_msg.photo_links(msgs, index)
+        files = archive.media_files(peer_path, msgs, audio, photo, index, taken)
+        sources, wanted = archive.download_plan(files, photo, blobs, photo_size, revalidate, originals)
+        ext = {sources[url]: os.path.splitext(paths[0])[1] for url, paths in files.items()}
+        claimed = blobs.claim(wanted)
+        downloads = []
+        for url in claimed:
+            future = downloader.submit(url, blobs.incoming_path(url),
+                                       lambda url, file, sha256, validators: blobs.add(
+                                           url, file, os.path.getsize(file), sha256, ext[url], validators),
+                                       blobs.validators(url))
+            future.add_done_callback(lambda future, url=url: downloaded(url, future))
+            downloads.append(future)
+        futures.extend(downloads)
+        progress.total += len(downloads)
+        progress.refresh()
+        return Batch(msgs, audio, photo, files, sources, downloads, claimed, users.submit(m.participants, msgs))
+
+    def produce() -> None:
+        try:
+            stored = store.messages(key)
+            for msgs in iter(lambda: list(islice(stored, STORED_BATCH)), []):
+                if stop.is_set():
+                    return
+                batches.put(prepare(msgs))
+            for msgs in m.iter_sync(store, peer_id, is_chat):
+                if stop.is_set():
+                    return
+                msgs = [msg for msg in msgs if msg['mid'] > last]  # first batch overlaps stored messages
+                if msgs:
+                    batches.put(prepare(msgs))
+            summary['fetched'] = time.time() - started
+            batches.put(DONE)
+        except BaseException as e:  # raised again in calling thread
+            batches.put(e)
+
+    def local(file: str) -> str:
+        return quote(os.path.relpath(file, peer_path).replace(os.sep, '/'))
+
+    media = {}
+    participants = {}
+    audio, photo = [], []
+
+    def ready() -> Iterator[Dict]:
+        while True:
+            batch = batches.get()
+            if batch is DONE:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            with metrics.timer('pipeline.wait'):
+                wait(batch.downloads)
+                blobs.release(batch.claimed)
+                blobs.wait(list(batch.sources.values()))  # urls claimed by other peers archived at the same time
+                participants.update(batch.users.result())
+            for url, paths in batch.files.items():
+                if blobs.get(batch.sources[url]) is not None:
+                    for file in paths:
+                        blobs.link(batch.sources[url], file)
+                if os.path.isfile(paths[0]):
+                    media[url] = dict(file=local(paths[0]))
+            if thumbnailer is not None:
+                photo_links = {p['biggest'] for p in batch.photo}
+                thumbs = {url: os.path.join(thumb_path, os.path.splitext(os.path.basename(paths[0]))[0] + '.jpg')
+                          for url, paths in batch.files.items() if url in media and url in photo_links}
+                made = set(thumbnailer.make([(batch.files[url][0], thumb) for url, thumb in thumbs.items()]))
+                for url, thumb in thumbs.items():
+                    if thumb in made:
+                        media[url]['thumb'] = local(thumb)
+            audio.extend(batch.audio)
+            photo.extend(batch.photo)
+            summary['messages'] += len(batch.msgs)
+            yield from batch.msgs
+
+    producer = threading.Thread(target=produce, name='pipeline-{}'.format(name), daemon=True)
+    producer.start()
+    try:
+        html_backup.render(peer_path, name, ready(), participants, audio, photo, page_by, page_size, media)
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        producer.join()
+        while not batches.empty():  # batches prepared after rendering failed
+            batch = batches.get()
+            if isinstance(batch, Batch):
+                wait(batch.downloads)
+                blobs.release(batch.claimed)
+        users.shutdown()
+        progress.close()
+        blobs.save()
+    summary.update(participants=len(participants), audios=len(audio), photos=len(photo))
+    return summary
@@ -0,0 +1,122 @@
+import random
+import threading
+import time
+from functools import reduce
+from typing import Any
+
+from vk.api import API as VKAPI
+from vk.exceptions import VkAPIError
+
+from vkbackup.metrics import metrics
+
+TOO_MANY_REQUESTS = 6
+FLOOD_CONTROL = 9
+
+
+class RateLimiter:
+    """Token bucket shared by every api call.
+
+    Rate adapts to the api: it is halved each time the api reports too many requests
+    and slowly restored to the configured value while calls succeed.
+    """
+
+    def __init__(self, rate: float = 3.0, burst: int = 1, min_rate: float = 0.2) -> None:
+        """
+        :param rate: allowed requests per second
+        :param burst: how many requests can be made at once after idling
+        :param min_rate: rate never goes below this after backing off
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until request is allowed."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self) -> None:
+        """Api complained about request rate: halve it."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self) -> None:
+        """Request succeeded: move rate back towards the configured one."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimitedAPI:
+    """Proxy of vk api, passing every call through limiter and retrying on rate errors.
+
+    Used the same way as vk api itself: ``api.messages.getHistory(...)``.
+    """
+
+    def __init__(self, vkapi: VKAPI, limiter: RateLimiter, retries: int = 8, backoff: float = 0.5) -> None:
+        """
+        :param vkapi: connected vk api
+        :param limiter: limiter, can be shared by several apis using the same token
+        :param retries: how many times to retry call failed with error 6 or 9
+        :param backoff: base delay in seconds, doubled on each retry
+        """
+        self.vkapi = vkapi
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+
+    def __getattr__(self, name: str) -> '_Method':
+        return _Method(self, name)
+
+    def call(self, method: str, **params) -> Any:
+        """Call api method respecting rate limit.
+
+        :param method: method name like 'messages.getHistory'
+        :param params: method parameters
+        :return: method result
+        """
+        attempt = 0
+        while True:
+            with metrics.timer('api.wait'):
+                self.limiter.acquire()
+            metrics.count('api.calls.' + method)
+            started = time.perf_counter()
+            try:
+                result = reduce(getattr, method.split('.'), self.vkapi)(**params)
+            except VkAPIError as e:
+                metrics.observe('api.latency', time.perf_counter() - started)
+                metrics.count('api.errors.{}'.format(e.code))
+                if e.code not in (TOO_MANY_REQUESTS, FLOOD_CONTROL) or attempt >= self.retries:
+                    raise
+                metrics.count('api.retries')
+                self.limiter.slow_down()
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))  # full jitter
+                attempt += 1
+            else:
+                metrics.observe('api.latency', time.perf_counter() - started)
+                metrics.observe('api.latency.' + method, time.perf_counter() - started)
+                self.limiter.speed_up()
+                return result
+
+
+class _Method:
+    def __init__(self, api: RateLimitedAPI, name: str) -> None:
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, name: str) -> '_Method':
+        return _Method(self._api, self._name + '.' + name)
+
+    def __call__(self, **params) -> Any:
+        return self._api.call(self._name, **params)
@@ -0,0 +1,174 @@
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from vkbackup.store import MessageStore
+
+ATTACHMENT_TEXT_FIELDS = ('artist', 'performer', 'title', 'text', 'url', 'description')
+
+
+def attachment_text(attach: Dict) -> str:
+    """Searchable text of attachment: titles, texts and links, wall post attachments included."""
+    obj = attach.get(attach['type'], None) or {}
+    parts = [str(obj[field]) for field in ATTACHMENT_TEXT_FIELDS if obj.get(field)]
+    parts += [attachment_text(inner) for inner in obj.get('attachments', None) or []]
+    return ' '.join(parts)
+
+
+def documents(msg: Dict) -> Iterator[Tuple[str, int, str]]:
+    """Pieces of message to index: body, forwarded bodies at any depth, attachments.
+
+    :param msg: message object
+    :return: generator of (kind, author uid, text)
+    """
+    def walk(m: Dict, author: int, kind: str) -> Iterator[Tuple[str, int, str]]:
+        if m.get('body'):
+            yield kind, author, m['body'].replace('<br>', '\n')
+        attachments = ' '.join(attachment_text(a) for a in m.get('attachments', None) or [])
+        if attachments.strip():
+            yield 'attachment', author, attachments
+        for fwd_msg in m.get('fwd_messages', None) or []:
+            yield from walk(fwd_msg, fwd_msg.get('uid'), 'fwd')
+
+    return walk(msg, msg.get('from_id'), 'body')
+
+
+def check_query(query: str) -> None:
+    """Raise ValueError if query is not a valid FTS5 query, like foo-bar or one with unbalanced quote."""
+    db = sqlite3.connect(':memory:')
+    try:
+        db.execute('CREATE VIRTUAL TABLE t USING fts5(text)')
+        db.execute('INSERT INTO t (text) VALUES (?)', ('',))  # query is parsed only if there are rows to match
+        db.execute('SELECT rowid FROM t WHERE t MATCH ?', (query,)).fetchall()
+    except sqlite3.OperationalError as e:
+        raise ValueError('bad query {!r}: {}; put words with punctuation in double quotes'.format(query, e))
+    finally:
+        db.close()
+
+
+class SearchIndex:
+    """Full-text index over stored messages, built with sqlite FTS5.
+
+    Kept in the same database file as message store; indexing is incremental, only messages
+    stored after the previous update are added, by rowid of store, so messages stored later
+    with lower ids are indexed too.
+    """
+
+    BATCH = 1000  # messages indexed in one transaction
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: path to sqlite database file
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS search_docs (
+                                   id INTEGER PRIMARY KEY,
+                                   peer TEXT NOT NULL,
+                                   mid INTEGER NOT NULL,
+                                   author INTEGER,
+                                   date INTEGER NOT NULL,
+                                   kind TEXT NOT NULL)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS search_docs_peer_date ON search_docs (peer, date)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS search_docs_author ON search_docs (author)')
+            self.db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_text
+                               USING fts5(text, tokenize = 'unicode61 remove_diacritics 2')''')
+            # search_state of earlier versions kept the last indexed message id, which missed messages
+            # stored later with lower ids; peers indexed that way are indexed again
+            self.db.execute('''CREATE TABLE IF NOT EXISTS search_state (
+                                   peer TEXT PRIMARY KEY,
+                                   last_mid INTEGER NOT NULL)''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS search_progress (
+                                   peer TEXT PRIMARY KEY,
+                                   last_rowid INTEGER NOT NULL)''')
+            for peer, in self.db.execute('''SELECT peer FROM search_state
+                                            WHERE peer NOT IN (SELECT peer FROM search_progress)''').fetchall():
+                self.db.execute('''DELETE FROM search_text
+                                   WHERE rowid IN (SELECT id FROM search_docs WHERE peer = ?)''', (peer,))
+                self.db.execute('DELETE FROM search_docs WHERE peer = ?', (peer,))
+            self.db.execute('DELETE FROM search_state')
+
+    def add(self, peer: str, msgs: Iterable[Dict], last_rowid: int = None) -> int:
+        """Index messages of peer.
+
+        :param peer: peer key, see store.peer_key
+        :param msgs: message objects
+        :param last_rowid: rowid in store of the last of msgs, remembered to continue from by update
+        :return: number of indexed messages
+        """
+        n = 0
+        with self.lock, self.db:
+            for msg in msgs:
+                for kind, author, text in documents(msg):
+                    doc_id = self.db.execute(
+                        'INSERT INTO search_docs (peer, mid, author, date, kind) VALUES (?, ?, ?, ?, ?)',
+                        (peer, msg['mid'], author, msg['date'], kind)
+                    ).lastrowid
+                    self.db.execute('INSERT INTO search_text (rowid, text) VALUES (?, ?)', (doc_id, text))
+                n += 1
+            if last_rowid is not None:
+                self.db.execute('INSERT OR REPLACE INTO search_progress (peer, last_rowid) VALUES (?, ?)',
+                                (peer, last_rowid))
+        return n
+
+    def last_rowid(self, peer: str) -> int:
+        """Rowid in store of the last indexed message of peer, 0 if nothing is indexed."""
+        with self.lock:
+            row = self.db.execute('SELECT last_rowid FROM search_progress WHERE peer = ?', (peer,)).fetchone()
+        return row[0] if row else 0
+
+    def update(self, store: MessageStore, peer: str) -> int:
+        """Index messages of peer stored since the previous update.
+
+        Messages are indexed in batches, so the database is not locked for long.
+
+        :return: number of indexed messages
+        """
+        n = 0
+        page = []
+        last_rowid = None
+        for last_rowid, msg in store.stored_since(peer, self.last_rowid(peer)):
+            page.append(msg)
+            if len(page) == self.BATCH:
+                n += self.add(peer, page, last_rowid)
+                page = []
+        return n + self.add(peer, page, last_rowid) if page else n
+
+    def search(self, query: str, peer: str = None, author: int = None, since: datetime = None,
+               until: datetime = None, limit: int = 50) -> List[Dict]:
+        """Find messages matching FTS5 query.
+
+        :param query: FTS5 query, like 'word', '"exact phrase"' or 'prefix*'
+        :param peer: search only conversation with this key
+        :param author: search only texts written by user with this uid
+        :param since: search only messages sent at or after this time
+        :param until: search only messages sent before this time
+        :param limit: max number of results
+        :return: list of dicts with peer, mid, author, date, kind and snippet, most relevant first
+        """
+        conditions = ['search_text MATCH ?']
+        params = [query]
+        for condition, value in (('d.peer = ?', peer),
+                                 ('d.author = ?', author),
+                                 ('d.date >= ?', int(since.timestamp()) if since else None),
+                                 ('d.date < ?', int(until.timestamp()) if until else None)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        with self.lock:
+            rows = self.db.execute(
+                '''SELECT d.peer, d.mid, d.author, d.date, d.kind,
+                          snippet(search_text, 0, '[', ']', '...', 16)
+                   FROM search_text JOIN search_docs d ON d.id = search_text.rowid
+                   WHERE {}
+                   ORDER BY rank
+                   LIMIT ?'''.format(' AND '.join(conditions)),
+                params + [limit]
+            ).fetchall()
+        return [dict(peer=peer, mid=mid, author=author, date=date, kind=kind, snippet=snippet)
+                for peer, mid, author, date, kind, snippet in rows]
+
+    def close(self) -> None:
+        self.db.close()
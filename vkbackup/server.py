@@ -0,0 +1,248 @@
+import json
+import os
+import re
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mimetypes import guess_type
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from vkbackup import archive, html_backup, vk_msg
+from vkbackup.manifest import Manifest
+from vkbackup.store import MessageStore
+
+STEP = 1000  # messages between marks of offset index
+PAGE_LIMIT = 500  # max messages returned at once
+COPY_CHUNK = 256 * 1024
+RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+class OffsetIndex:
+    """Positions of stored messages of one peer, made of every STEP-th message id and date.
+
+    Message at any position, or the first one sent at some date, is found with one query
+    reading at most STEP rows, and the index of a million messages takes a thousand entries.
+    """
+
+    def __init__(self, store: MessageStore, peer: str, step: int = STEP) -> None:
+        self.store = store
+        self.peer = peer
+        self.step = step
+        self.marks = store.marks(peer, step)
+        self.dates = [date for _, date in self.marks]
+        self.count = store.count(peer)
+
+    def messages(self, offset: int, limit: int) -> List[Dict]:
+        """Messages at positions offset to offset + limit, in chronological order."""
+        if not 0 <= offset < self.count:
+            return []
+        return self.store.page(self.peer, self.marks[offset // self.step][0], offset % self.step, limit)
+
+    def position(self, date: int) -> int:
+        """Position of the first message sent at date or later, count if there is none.
+
+        :param date: unix time
+        """
+        if not self.marks:
+            return 0
+        block = max(bisect_left(self.dates, date) - 1, 0)
+        high = self.marks[block + 1][0] if block + 1 < len(self.marks) else None
+        return block * self.step + self.store.count_before(self.peer, self.marks[block][0], high, date)
+
+
+class ManifestMedia:
+    """Links to local copies of media downloaded by archive action, served under /media/."""
+
+    def __init__(self, manifest: Manifest) -> None:
+        self.manifest = manifest
+
+    def get(self, url: str) -> Optional[Dict[str, str]]:
+        path = self.manifest.local_path(url)
+        if path is None:
+            return None
+        return dict(file='/media/' + quote(os.path.relpath(path, self.manifest.root).replace(os.sep, '/')))
+
+
+class Viewer:
+    """Data of archive viewer: stored conversations, their messages page by page and media files."""
+
+    def __init__(self, store: MessageStore, m: vk_msg.VkMessages, root: str = '.') -> None:
+        """
+        :param store: local message store
+        :param m: VkMessages instance, users are taken from its cache only
+        :param root: archive root, media downloaded by archive action are served from there
+        """
+        self.store = store
+        self.m = m
+        self.root = os.path.realpath(root)
+        self.media = ManifestMedia(Manifest(root)) if os.path.isfile(os.path.join(root, Manifest.FILENAME)) else None
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+    def index(self, peer: str) -> Optional[OffsetIndex]:
+        """Offset index of peer, made on first use; None if nothing of peer is stored."""
+        with self.lock:
+            if peer not in self.indexes:
+                index = OffsetIndex(self.store, peer)
+                if not index.count:
+                    return None
+                self.indexes[peer] = index
+            return self.indexes[peer]
+
+    def peers(self) -> List[Dict]:
+        """Stored conversations with names of users known to user cache."""
+        keys = sorted(self.store.peers())
+        users = self.m.users.get_many([k for k in keys if not k.startswith('chat')], stale=True) \
+            if self.m.users is not None else {}
+        return [dict(key=key,
+                     name=vk_msg.user_full_name(users[key]) if key in users else key,
+                     count=self.store.count(key))
+                for key in keys]
+
+    def messages(self, index: OffsetIndex, offset: int, limit: int) -> Dict:
+        """Html representation of messages at positions offset to offset + limit, see html_backup.iter_html_repr."""
+        msgs = index.messages(offset, min(limit, PAGE_LIMIT))
+        participants = self.m.participants(msgs, offline=True)
+        return dict(offset=offset, count=index.count,
+                    messages=list(html_backup.iter_html_repr(msgs, participants, self.media)))
+
+    def media_path(self, link: str) -> Optional[str]:
+        """File of /media/ link, only blobs and media folders of peers are served."""
+        path = os.path.realpath(os.path.join(self.root, unquote(link)))
+        parts = os.path.relpath(path, self.root).split(os.sep)
+        allowed = parts[0] == 'blobs' or len(parts) > 2 and parts[1] in archive.MEDIA_FOLDERS + ('thumbs',)
+        if path.startswith(self.root + os.sep) and allowed and os.path.isfile(path):
+            return path
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Routes of archive viewer.
+
+    /                                  list of conversations
+    /peer/<peer>                       virtual-scrolling viewer of conversation
+    /api/<peer>/messages?offset=&limit=  JSON page of messages
+    /api/<peer>/position?date=YYYY-MM-DD position of the first message sent at date
+    /media/<path>                      local media, with range requests
+    """
+
+    server_version = 'vkbackup'
+    viewer = None  # type: Viewer
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/':
+                self.send_text(html_backup.env.get_template('peers.html').render(peers=self.viewer.peers()))
+            elif parts[0] == 'peer' and len(parts) == 2:
+                index = self.viewer.index(parts[1])
+                if index is None:
+                    return self.send_error(HTTPStatus.NOT_FOUND)
+                self.send_text(html_backup.env.get_template('viewer.html').render(peer=parts[1], count=index.count))
+            elif parts[0] == 'api' and len(parts) == 3:
+                index = self.viewer.index(parts[1])
+                if index is None:
+                    return self.send_json(dict(error='unknown peer'), HTTPStatus.NOT_FOUND)
+                if parts[2] == 'messages':
+                    self.send_json(self.viewer.messages(index, int(query.get('offset', 0)),
+                                                        int(query.get('limit', 100))))
+                elif parts[2] == 'position':
+                    date = datetime.strptime(query['date'], '%Y-%m-%d').timestamp()
+                    self.send_json(dict(position=index.position(int(date)), count=index.count))
+                else:
+                    self.send_json(dict(error='unknown method'), HTTPStatus.NOT_FOUND)
+            elif parts[0] == 'media':
+                path = self.viewer.media_path(url.path[len('/media/'):])
+                if path is None:
+                    return self.send_error(HTTPStatus.NOT_FOUND)
+                self.send_file(path)
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except (KeyError, ValueError) as e:
+            self.send_json(dict(error='bad request: {}'.format(e)), HTTPStatus.BAD_REQUEST)
+        except (BrokenPipeError, ConnectionResetError):  # browser dropped request, like media it no longer shows
+            pass
+
+    def send_text(self, text: str, content_type: str = 'text/html; charset=utf-8',
+                  status: HTTPStatus = HTTPStatus.OK) -> None:
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, obj: Dict, status: HTTPStatus = HTTPStatus.OK) -> None:
+        self.send_text(json.dumps(obj, ensure_ascii=False), 'application/json; charset=utf-8', status)
+
+    def send_file(self, path: str) -> None:
+        """Send file or the byte range of it asked for; malformed and multiple ranges are ignored."""
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = RANGE.fullmatch(self.headers.get('Range', '').strip())
+        if match and any(match.groups()):
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:  # suffix range, last bytes of file
+                start = max(size - int(last), 0)
+            if start > end:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Cache-Control', 'max-age=86400')  # blobs are named by content, they never change
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(COPY_CHUNK, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass  # every scroll makes requests, logging them would flood the terminal
+
+
+def make_server(viewer: Viewer, host: str = '127.0.0.1', port: int = 8000) -> ThreadingHTTPServer:
+    """Http server of viewer, not started yet; port 0 picks a free one."""
+    handler = type('ViewerHandler', (Handler,), dict(viewer=viewer))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(viewer: Viewer, host: str = '127.0.0.1', port: int = 8000, peer: str = None) -> None:
+    """Serve archive viewer until interrupted.
+
+    :param viewer: data of viewer
+    :param host: address to listen on, local only by default
+    :param port: port to listen on
+    :param peer: key of conversation to print link to
+    """
+    server = make_server(viewer, host, port)
+    address = 'http://{}:{}/'.format(*server.server_address[:2])
+    print('Serving archive at {}{}, press Ctrl+C to stop'.format(
+        address, 'peer/' + quote(peer) if peer else ''))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,167 @@
+import json
+import sqlite3
+import threading
+from typing import List, Dict, Iterator, Optional, Tuple, Union
+
+from vkbackup.metrics import metrics
+
+
+def peer_key(id: Union[str, int], is_chat: bool = False) -> str:
+    """Key under which conversation is kept in the store.
+
+    :param id: resolved user_id or chat_id
+    :param is_chat: if True, id is treated as chat_id
+    :return: string key like '1234' or 'chat42'
+    """
+    return 'chat{}'.format(id) if is_chat else str(id)
+
+
+class MessageStore:
+    """Persistent local store of fetched messages, keyed by peer and message id."""
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: path to sqlite database file, created if missing
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')  # readers do not wait for writers
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS messages (
+                                   peer TEXT NOT NULL,
+                                   mid INTEGER NOT NULL,
+                                   date INTEGER NOT NULL,
+                                   data TEXT NOT NULL,
+                                   PRIMARY KEY (peer, mid))''')
+            # covers offset index of viewer, which needs dates of messages but not their data
+            self.db.execute('CREATE INDEX IF NOT EXISTS messages_peer_mid_date ON messages (peer, mid, date)')
+            # entries of index are ordered by rowid within peer, so messages are read in order of storing
+            self.db.execute('CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer)')
+
+    def add(self, peer: str, msgs: List[Dict]) -> int:
+        """Store messages, ignoring those already present.
+
+        :param peer: peer key, see peer_key
+        :param msgs: message objects
+        :return: number of newly stored messages
+        """
+        with self.lock, self.db, metrics.timer('store.write'):
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO messages (peer, mid, date, data) VALUES (?, ?, ?, ?)',
+                ((peer, msg['mid'], msg['date'], json.dumps(msg)) for msg in msgs)
+            )
+            return self.db.total_changes - before
+
+    def count(self, peer: str) -> int:
+        """Number of stored messages of peer."""
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM messages WHERE peer = ?', (peer,)).fetchone()[0]
+
+    def last_mid(self, peer: str) -> int:
+        """Id of the last synced message of peer, 0 if nothing is stored."""
+        with self.lock:
+            return self.db.execute('SELECT MAX(mid) FROM messages WHERE peer = ?', (peer,)).fetchone()[0] or 0
+
+    def peers(self) -> List[str]:
+        """Keys of all stored conversations."""
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT DISTINCT peer FROM messages')]
+
+    def messages(self, peer: str, after: int = 0) -> Iterator[Dict]:
+        """Stored messages of peer in chronological order.
+
+        Messages are read page by page, so the whole conversation is never held in memory.
+
+        :param peer: peer key, see peer_key
+        :param after: yield only messages with id greater than this
+        """
+        while True:
+            with metrics.timer('store.read'):
+                with self.lock:
+                    page = self.db.execute(
+                        'SELECT mid, data FROM messages WHERE peer = ? AND mid > ? ORDER BY mid LIMIT ?',
+                        (peer, after, self.PAGE_SIZE)
+                    ).fetchall()
+                msgs = [json.loads(data) for mid, data in page]
+            if not page:
+                return
+            yield from msgs
+            after = page[-1][0]
+
+    def stored_since(self, peer: str, rowid: int = 0) -> Iterator[Tuple[int, Dict]]:
+        """Messages of peer stored after the row with rowid, in order of storing.
+
+        Unlike messages(after=...), this finds older messages stored later too, like history
+        fetched again after a gap.
+
+        :param peer: peer key, see peer_key
+        :param rowid: rowid of the last row seen before, 0 for all messages
+        :return: generator of (rowid, message)
+        """
+        while True:
+            with metrics.timer('store.read'):
+                with self.lock:
+                    page = self.db.execute(
+                        'SELECT rowid, data FROM messages WHERE peer = ? AND rowid > ? ORDER BY rowid LIMIT ?',
+                        (peer, rowid, self.PAGE_SIZE)
+                    ).fetchall()
+            if not page:
+                return
+            for rowid, data in page:
+                yield rowid, json.loads(data)
+
+    def marks(self, peer: str, step: int) -> List[Tuple[int, int]]:
+        """Id and date of every step-th stored message of peer, starting with the first one.
+
+        They make a sparse index of positions: message number i is found by skipping i % step
+        messages from marks[i // step], without counting all messages before it.
+
+        :param peer: peer key, see peer_key
+        :param step: messages between marks
+        :return: list of (mid, date) in chronological order
+        """
+        marks = []
+        with self.lock:
+            mark = self.db.execute('SELECT mid, date FROM messages WHERE peer = ? ORDER BY mid LIMIT 1',
+                                   (peer,)).fetchone()
+            while mark is not None:  # every query walks step entries of index from the previous mark
+                marks.append(mark)
+                mark = self.db.execute(
+                    'SELECT mid, date FROM messages WHERE peer = ? AND mid > ? ORDER BY mid LIMIT 1 OFFSET ?',
+                    (peer, mark[0], step - 1)
+                ).fetchone()
+        return marks
+
+    def page(self, peer: str, mid: int, skip: int = 0, limit: int = PAGE_SIZE) -> List[Dict]:
+        """Stored messages of peer from message id on, in chronological order.
+
+        :param peer: peer key, see peer_key
+        :param mid: id of the first message, or of a message before it
+        :param skip: number of messages skipped from mid on
+        :param limit: max number of returned messages
+        """
+        with self.lock, metrics.timer('store.read'):
+            rows = self.db.execute(
+                'SELECT data FROM messages WHERE peer = ? AND mid >= ? ORDER BY mid LIMIT ? OFFSET ?',
+                (peer, mid, limit, skip)
+            ).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def count_before(self, peer: str, low: int, high: Optional[int], date: int) -> int:
+        """Number of stored messages of peer with low <= mid < high sent before date.
+
+        :param high: upper bound of ids, None for no bound
+        :param date: unix time
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM messages WHERE peer = ? AND mid >= ? AND mid < ? AND date < ?',
+                (peer, low, high if high is not None else 2 ** 63 - 1, date)
+            ).fetchone()[0]
+
+    def close(self) -> None:
+        self.db.close()
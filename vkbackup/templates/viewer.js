@@ -0,0 +1,142 @@
+// Virtual scrolling: only rows in view are in the page, fetched by pages of PAGE messages.
+// Scrollbar of tall spacer maps to message position, rows block stays at the top of viewport.
+var PAGE = 100;
+var ROWS = 40;  // rows rendered at once, more than fit in the viewport
+var PIXELS_PER_MESSAGE = 24;
+var MAX_HEIGHT = 8000000;  // browsers limit element height
+var KEPT_PAGES = 50;
+
+var viewport = document.getElementById('viewport');
+var tbody = document.querySelector('#rows tbody');
+var pages = new Map();  // page number -> promise of messages
+var shown = -1;
+var scheduled = false;
+
+document.getElementById('spacer').style.height = Math.min(COUNT * PIXELS_PER_MESSAGE, MAX_HEIGHT) + 'px';
+
+function page(number) {
+    if (!pages.has(number)) {
+        pages.set(number, fetch('/api/' + encodeURIComponent(PEER) + '/messages?offset=' + number * PAGE + '&limit=' + PAGE)
+            .then(function (response) { return response.json(); })
+            .then(function (data) { return data.messages; }));
+        if (pages.size > KEPT_PAGES) {
+            pages.delete(pages.keys().next().value);
+        }
+    }
+    return pages.get(number);
+}
+
+function firstShown() {
+    var max = viewport.scrollHeight - viewport.clientHeight;
+    return max > 0 ? Math.round(viewport.scrollTop / max * Math.max(COUNT - ROWS, 0)) : 0;
+}
+
+function element(tag, attrs, children) {
+    var e = document.createElement(tag);
+    Object.keys(attrs || {}).forEach(function (name) {
+        if (attrs[name] !== null && attrs[name] !== undefined) {
+            e.setAttribute(name, attrs[name]);
+        }
+    });
+    (children || []).forEach(function (child) {
+        if (child !== null && child !== undefined) {
+            e.appendChild(typeof child === 'string' ? document.createTextNode(child) : child);
+        }
+    });
+    return e;
+}
+
+function link(href, text) {
+    return element('a', {href: href || '', target: '_blank'}, [text || '']);
+}
+
+// same as make_attachment of attachment.html
+function attachment(a) {
+    switch (a.type) {
+        case 'photo':
+            return element('a', {href: a.file || a.biggest, target: '_blank'},
+                           [element('img', {loading: 'lazy', src: a.thumb || a.file || a.src})]);
+        case 'audio':
+            return link(a.file || (a.content_restricted ? '' : a.url), a.artist + ' - ' + a.title);
+        case 'sticker':
+            return element('img', {loading: 'lazy', src: a.file || a.photo_128});
+        case 'doc':
+            return element('span', {}, ['[' + a.ext + ' ' + a.size + '] ', link(a.url, a.title)]);
+        case 'video':
+            return element('span', {}, [element('img', {loading: 'lazy', src: a.file || a.image}), element('p', {}, [a.title])]);
+        case 'wall':
+            return element('span', {}, [element('p', {}, ['Wall:' + a.text])].concat((a.attachments || []).map(attachment)));
+        case 'link':
+            return link(a.url, a.title);
+    }
+    return null;
+}
+
+function user(u, full) {
+    return link('https://vk.com/' + u.screen_name, full ? u.first_name + ' ' + u.last_name : u.first_name);
+}
+
+// same as messages.html and forwarded.html
+function row(msg, forwarded) {
+    var body = [msg.body];
+    if (!forwarded && msg.forwarded) {
+        body.push(element('br'), 'форв', element('div', {'class': 'datagrid inner'}, [
+            element('table', {}, [element('tbody', {}, msg.forwarded.map(function (f) { return row(f, true); }))])
+        ]));
+    }
+    return element('tr', {bgcolor: msg.is_out && !forwarded ? '#E1EEF4' : null}, [
+        element('td', {}, [msg.date]),
+        element('td', {}, [user(msg.user, !forwarded)]),
+        element('td', {}, body),
+        element('td', {}, (msg.attachments || []).map(attachment))
+    ]);
+}
+
+function render() {
+    scheduled = false;
+    var first = firstShown();
+    if (first === shown) {
+        return;
+    }
+    shown = first;
+    var last = Math.min(first + ROWS, COUNT);
+    var numbers = [];
+    for (var n = Math.floor(first / PAGE); n * PAGE < last; n++) {
+        numbers.push(n);
+    }
+    Promise.all(numbers.map(page)).then(function (loaded) {
+        if (first !== shown) {
+            return;  // scrolled on while pages were loading
+        }
+        var msgs = [].concat.apply([], loaded);
+        var offset = first - numbers[0] * PAGE;
+        tbody.replaceChildren.apply(tbody, msgs.slice(offset, offset + last - first).map(function (msg) { return row(msg, false); }));
+        document.getElementById('position').textContent = (first + 1) + '–' + last + ' of ' + COUNT;
+    });
+}
+
+viewport.addEventListener('scroll', function () {
+    if (!scheduled) {
+        scheduled = true;
+        requestAnimationFrame(render);
+    }
+});
+
+// wheel over rows scrolls by messages, not by pixels of the spacer
+viewport.addEventListener('wheel', function (event) {
+    var max = viewport.scrollHeight - viewport.clientHeight;
+    var step = max / Math.max(COUNT - ROWS, 1) * 3;
+    viewport.scrollTop += Math.sign(event.deltaY) * Math.max(step, 1);
+    event.preventDefault();
+}, {passive: false});
+
+document.getElementById('date').addEventListener('change', function (event) {
+    fetch('/api/' + encodeURIComponent(PEER) + '/position?date=' + event.target.value)
+        .then(function (response) { return response.json(); })
+        .then(function (data) {
+            var max = viewport.scrollHeight - viewport.clientHeight;
+            viewport.scrollTop = Math.min(data.position, Math.max(COUNT - ROWS, 0)) / Math.max(COUNT - ROWS, 1) * max;
+        });
+});
+
+render();
@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import List, Tuple
+
+from tqdm import tqdm
+
+from vkbackup.metrics import metrics
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional, archive links originals without them
+    Image = None
+
+SIZE = 320  # max side of thumbnail, a bit larger than gallery tiles
+QUALITY = 80
+
+
+def make_thumbnail(src: str, dst: str, size: int = SIZE) -> bool:
+    """Save downscaled copy of image as JPEG.
+
+    Runs in worker processes of Thumbnailer.
+
+    :param src: image file
+    :param dst: thumbnail file, written atomically
+    :param size: max width and height of thumbnail
+    :return: False if src is not an image Pillow can read
+    """
+    tmp = dst + '.tmp'
+    try:
+        with Image.open(src) as image:
+            image.draft('RGB', (size, size))  # JPEG is downscaled while decoding, much faster than resizing after
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(tmp, 'JPEG', quality=QUALITY, optimize=True)
+        os.replace(tmp, dst)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
+class Thumbnailer:
+    """Makes thumbnails of downloaded photos in a pool of processes, one per cpu core by default."""
+
+    def __init__(self, processes: int = None, size: int = SIZE) -> None:
+        """
+        :param processes: number of worker processes, cpu count by default
+        :param size: max width and height of thumbnails
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.size = size
+        self.pool = None  # started on first use, shared by concurrent make calls
+        self.warned = False
+
+    def make(self, jobs: List[Tuple[str, str]], desc: str = 'Making thumbnails') -> List[str]:
+        """Make thumbnails that do not exist yet.
+
+        Without Pillow installed a warning is printed once and nothing is made.
+
+        :param jobs: list of (image file, thumbnail file)
+        :param desc: progress bar title
+        :return: thumbnail files present after the call
+        """
+        if Image is None:
+            if not self.warned:
+                print('Pillow is not installed, thumbnails are not made (pip install Pillow)', file=sys.stderr)
+                self.warned = True
+            return []
+        done = [dst for src, dst in jobs if os.path.isfile(dst)]
+        todo = [(src, dst) for src, dst in jobs if not os.path.isfile(dst)]
+        if not todo:
+            return done
+        if self.pool is None:
+            # spawned rather than forked, downloads and history fetch run in threads meanwhile
+            self.pool = ProcessPoolExecutor(self.processes, multiprocessing.get_context('spawn'))
+        chunksize = max(1, len(todo) // (self.processes * 4))  # few round trips to workers, still balanced
+        with tqdm(desc=desc, unit='img', total=len(todo)) as progress, metrics.timer('thumbnails'):
+            made = self.pool.map(make_thumbnail, [src for src, _ in todo], [dst for _, dst in todo],
+                                 repeat(self.size), chunksize=chunksize)
+            for (src, dst), ok in zip(todo, made):
+                metrics.count('thumbnails.made' if ok else 'thumbnails.failed')
+                if ok:
+                    done.append(dst)
+                else:
+                    tqdm.write('Failed to make thumbnail of {}'.format(src))
+                progress.update(1)
+        return done
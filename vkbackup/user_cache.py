@@ -0,0 +1,83 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple, Union
+
+USER_ID = re.compile(r'-?\d+|id(\d+)', re.IGNORECASE)  # numeric id, or id<number> link vk accepts for any user
+
+
+def user_key(user_id: str) -> Tuple[str, Union[int, str]]:
+    """Column of users table and value identifying user, as vk resolves them.
+
+    Numeric ids and id<number> are ids, anything else is a screen name, compared case-insensitively.
+    """
+    match = USER_ID.fullmatch(user_id)
+    if match:
+        return 'uid', int(match.group(1) or user_id)
+    return 'screen_name', user_id.lower()
+
+
+class UserCache:
+    """On-disk cache of users.get results, shared across runs and peers."""
+
+    QUERY_CHUNK = 500  # stay below sqlite limit of query variables
+
+    def __init__(self, path: str = ':memory:', ttl: float = 7 * 24 * 3600) -> None:
+        """
+        :param path: path to sqlite database file, by default cache lives in memory
+        :param ttl: seconds after which cached user is fetched again
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS users (
+                                   uid INTEGER PRIMARY KEY,
+                                   screen_name TEXT,
+                                   data TEXT NOT NULL,
+                                   fetched REAL NOT NULL)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS users_screen_name ON users (screen_name)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS users_screen_name_nocase '
+                            'ON users (screen_name COLLATE NOCASE)')
+
+    def get_many(self, user_ids: Iterable[str], stale: bool = False) -> Dict[str, Dict]:
+        """Fresh cached users.
+
+        :param user_ids: ids or screen names
+        :param stale: return users older than ttl too, for runs without access to api
+        :return: dict from requested id or screen name to user object, missing and stale users are omitted
+        """
+        requested = {}  # (column, value) -> requested ids meaning that user
+        for user_id in user_ids:
+            requested.setdefault(user_key(user_id), []).append(user_id)
+        oldest = -1 if stale else time.time() - self.ttl
+        found = {}
+        for column, collate in (('uid', ''), ('screen_name', ' COLLATE NOCASE')):
+            keys = [value for key_column, value in requested if key_column == column]
+            for i in range(0, len(keys), self.QUERY_CHUNK):
+                chunk = keys[i:i + self.QUERY_CHUNK]
+                with self.lock:
+                    rows = self.db.execute(
+                        'SELECT {0}, data FROM users WHERE fetched > ? AND {0}{1} IN ({2})'.format(
+                            column, collate, ','.join('?' * len(chunk))),
+                        [oldest] + chunk
+                    ).fetchall()
+                for key, data in rows:
+                    user = json.loads(data)
+                    for user_id in requested[user_key(str(key))]:
+                        found[user_id] = user
+        return found
+
+    def put_many(self, users: List[Dict]) -> None:
+        """Cache user objects returned by users.get."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO users (uid, screen_name, data, fetched) VALUES (?, ?, ?, ?)',
+                ((u['uid'], u.get('screen_name'), json.dumps(u), now) for u in users)
+            )
+
+    def close(self) -> None:
+        self.db.close()
@@ -2,22 +2,166 @@
 
 import argparse
 import sys
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from vk import Session, API
 
-from vkbackup import vk_msg, html_backup, archive
+from vkbackup import vk_msg, html_backup, archive, pipeline, server
+from vkbackup.blobs import BlobStore
+from vkbackup.bundle import Bundle
+from vkbackup.downloader import Downloader
+from vkbackup.metrics import Profiler, metrics
+from vkbackup.ratelimit import RateLimiter
+from vkbackup.search import SearchIndex, check_query
+from vkbackup.store import MessageStore, peer_key
+from vkbackup.thumbnails import Thumbnailer
+from vkbackup.user_cache import UserCache
 
 
-def print_list(l):
+def print_list(l, file=None):
     for x in l:
-        print(x)
+        print(x, file=file)
+
+
+def backup(args, m, store, peer_id, name, is_chat=False, downloader=None, blobs=None, to_file=False,
+           search_index=None, thumbnailer=None, bundle=None, originals=None):
+    """Run action for one peer.
+
+    :param args: parsed command line arguments
+    :param m: VkMessages instance
+    :param store: local message store
+    :param peer_id: id or screen name of user, or chat_id
+    :param name: name of peer in output file names
+    :param is_chat: if True, peer_id is treated as chat_id
+    :param downloader: media downloader for archive action
+    :param blobs: media store for archive action
+    :param to_file: text action writes to <name>.txt instead of stdout
+    :param search_index: if given, newly stored messages are added to it
+    :param thumbnailer: makes thumbnails of photos for archive action
+    :param bundle: archive action writes into this bundle instead of folders
+    :param originals: archive action fills it with original photos to fetch after all peers
+    :return: summary dict with timings and counts
+    """
+    started = time.time()
+    summary = dict(peer=name)
+    text_file = '{}.txt'.format(name) if to_file else None
+    actions = {
+        'text': lambda x, y: write_text(vk_msg.iter_text(x, y, processes=args.processes), text_file),
+        'json': lambda: m.save('.', peer_id, store, args.jsonl, is_chat, args.columnar),
+        'audio': lambda x: print_list([x for x in [a.get('url', None) for a in vk_msg.audio_links(x)] if x]),
+        'photo': lambda x: print_list([p['biggest'] for p in vk_msg.photo_links(x)]),
+        'html': lambda x, y, z, h: html_backup.render('.', name, x, y, z, h, args.page_by, args.page_size,
+                                                      processes=args.processes),
+        'archive': lambda x, y, z, h: (
+            archive.make('.', name, x, y, z, h, downloader, args.page_by, args.page_size, blobs, thumbnailer, index,
+                         args.processes, args.photo_size, args.revalidate, originals)
+            if bundle is None else
+            archive.make_bundle(bundle, name, x, y, z, h, downloader, args.page_by, args.page_size, thumbnailer, index)
+        )
+    }
+    action_args = []
+    index = None
+    if args.action == 'archive' and bundle is None and args.pipeline and not args.input:
+        with metrics.timer('stage.archive'):
+            summary.update(pipeline.archive_peer('.', m, store, peer_id, name, is_chat, downloader, blobs,
+                                                 thumbnailer, args.page_by, args.page_size, args.photo_size,
+                                                 args.revalidate, originals))
+        key = peer_key(peer_id if is_chat else m.get_user(peer_id)['uid'], is_chat)
+    elif not args.action == 'json':
+        if args.input:
+            with metrics.timer('stage.load'):
+                messages = list(vk_msg.load_dump(args.input))
+        else:
+            with metrics.timer('stage.sync'):
+                key = m.sync(store, peer_id, is_chat)
+            with metrics.timer('stage.load'):
+                messages = list(store.messages(key))
+        summary.update(messages=len(messages), fetched=time.time() - started)
+        action_args.append(messages)
+        if args.action in ('text', 'html', 'archive'):
+            with metrics.timer('stage.participants'):
+                part = m.participants(messages, offline=bool(args.input))
+            action_args.append(part)
+            summary['participants'] = len(part)
+        if args.action in ('html', 'archive'):
+            with metrics.timer('stage.links'):
+                index = vk_msg.index_attachments(messages)
+                audio_links = vk_msg.audio_links(messages, index)
+                photo_links = vk_msg.photo_links(messages, index)
+            action_args.append(audio_links)
+            action_args.append(photo_links)
+            summary.update(audios=len(audio_links), photos=len(photo_links))
+        with metrics.timer('stage.' + args.action):
+            actions[args.action](*action_args)
+    else:
+        with metrics.timer('stage.json'):
+            actions[args.action]()
+        key = peer_key(peer_id if is_chat else m.get_user(peer_id)['uid'], is_chat)
+    if search_index is not None and not args.input:
+        with metrics.timer('stage.index'):
+            search_index.update(store, key)
+    summary['total'] = time.time() - started
+    return summary
+
+
+def write_text(lines, path=None):
+    """Write lines to stdout, or to file at path if it is given."""
+    if path is None:
+        vk_msg.write_lines(lines, sys.stdout)
+    else:
+        with open(path, 'w', encoding='utf-8', buffering=2 ** 20) as f:
+            vk_msg.write_lines(lines, f)
+
+
+def search(args, m, store, search_index):
+    """Print messages matching query of search action."""
+    for peer in store.peers():  # index messages stored by runs made before index was introduced
+        search_index.update(store, peer)
+    if args.peer_id == 'all':
+        peer = None
+    elif args.peer_id.startswith('chat'):
+        peer = args.peer_id
+    else:
+        peer = str(m.get_user(args.peer_id)['uid'])
+    results = search_index.search(
+        args.query,
+        peer=peer,
+        author=m.get_user(args.author)['uid'] if args.author else None,
+        since=datetime.strptime(args.since, '%Y-%m-%d') if args.since else None,
+        until=datetime.strptime(args.until, '%Y-%m-%d') if args.until else None,
+        limit=args.limit
+    )
+    users = m.get_users(str(r['author']) for r in results if r['author'] is not None)
+    for r in results:
+        user = users.get(str(r['author']))
+        print('{} [{}] {}{}: {}'.format(
+            vk_msg.format_date(r['date']),
+            r['peer'],
+            vk_msg.user_full_name(user) if user else r['author'],
+            ' (forwarded)' if r['kind'] == 'fwd' else '',
+            r['snippet'].replace('\n', ' ')
+        ))
+
+
+def print_summary(summaries):
+    columns = ['peer', 'messages', 'participants', 'photos', 'audios', 'fetched', 'total', 'error']
+    rows = [[('{:.1f}s'.format(s[c]) if isinstance(s.get(c), float) else str(s.get(c, '')))[:60] for c in columns]
+            for s in summaries]
+    widths = [max(len(x) for x in column) for column in zip(columns, *rows)]
+    for row in [columns] + rows:
+        print('  '.join(x.ljust(w) for x, w in zip(row, widths)), file=sys.stderr)
 
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Vk.com backups.')
-    parser.add_argument('peer_id', type=str, help='id or screen name of user to backup')
+    parser.add_argument('peer_id', type=str,
+                        help='id or screen name of user to backup, several of them separated by commas, '
+                             'or "all" for every dialog')
     parser.add_argument('token', type=str, help='vk api token')
-    parser.add_argument('action', choices=['json', 'text', 'audio', 'photo', 'html', 'archive'], default='text',
+    parser.add_argument('action', choices=['json', 'text', 'audio', 'photo', 'html', 'archive', 'search', 'serve'],
+                        default='text',
                         help='''json: save raw messages to json file in current directory;
 
                                 text: output text representation of messages;
@@ -28,34 +172,155 @@ def main(argv):
 
                                 html: pretty local html with all stuff;
 
-                                archive: downloads everything into nice folder structure
+                                archive: downloads everything into nice folder structure;
+
+                                search: find stored messages matching --query, peer_id can be "all";
+
+                                serve: browse stored messages and archived media in browser, peer_id can be "all"
                                 ''')
+    parser.add_argument('--input', type=str,
+                        help='text, html, archive, audio, photo: read messages of peer_id from JSON, JSON Lines or '
+                             'columnar dump saved by json action instead of fetching them; users are taken from '
+                             'the cache in store, token is not used')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='text, html, archive: worker processes converting messages of long dialogs, '
+                             '0 for one per cpu core (default: %(default)s)')
+    parser.add_argument('--store', type=str, default='vkbackup.db',
+                        help='local message store, only messages missing there are downloaded (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=3.0,
+                        help='max vk api requests per second (default: %(default)s)')
+    parser.add_argument('--fetch-workers', type=int, default=3,
+                        help='concurrent requests fetching history of one dialog (default: %(default)s)')
+    parser.add_argument('--user-ttl', type=float, default=7,
+                        help='days to keep resolved users in the cache in store (default: %(default)s)')
+    parser.add_argument('--jsonl', action='store_true',
+                        help='json: write JSON Lines, one message per line, instead of JSON array')
+    parser.add_argument('--columnar', action='store_true',
+                        help='json: write compressed columnar archive folder <name>.vkcol instead of JSON')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='archive: number of parallel media downloads (default: %(default)s)')
+    parser.add_argument('--no-thumbnails', dest='thumbnails', action='store_false',
+                        help='archive: do not make thumbnails of photos, they need Pillow installed')
+    parser.add_argument('--no-pipeline', dest='pipeline', action='store_false',
+                        help='archive: fetch all messages first and download media after, instead of downloading '
+                             'and rendering while messages are fetched')
+    parser.add_argument('--photo-size', choices=sorted(vk_msg.PHOTO_SIZES), default='original',
+                        help='archive: download photos in this size first, up to 130, 604 or 1280 pixels wide, '
+                             'originals are downloaded after all dialogs are archived (default: %(default)s)')
+    parser.add_argument('--no-originals', dest='originals', action='store_false',
+                        help='archive: with --photo-size, do not download originals, for metered connections; '
+                             'the next run without this option downloads them')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='archive: ask server whether media downloaded before changed, with ETag, '
+                             'Last-Modified or size, and download again only changed ones')
+    parser.add_argument('--bundle', type=str,
+                        help='archive: stream everything into this zip file instead of folders, '
+                             'new media is appended to it on the next runs')
+    parser.add_argument('--page-by', choices=['month', 'count'], default='month',
+                        help='html, archive: split messages into a page per month or per --page-size messages '
+                             '(default: %(default)s)')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='html, archive: messages per page with --page-by count (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='peers backed up at the same time when there are several of them (default: %(default)s)')
+    parser.add_argument('-q', '--query', type=str,
+                        help='search: full-text query, like word, "exact phrase" or prefix*')
+    parser.add_argument('--author', type=str, help='search: only texts written by this user')
+    parser.add_argument('--since', type=str, help='search: only messages sent at or after date, YYYY-MM-DD')
+    parser.add_argument('--until', type=str, help='search: only messages sent before date, YYYY-MM-DD')
+    parser.add_argument('--limit', type=int, default=50, help='search: max number of results (default: %(default)s)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='serve: address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='serve: port to listen on (default: %(default)s)')
+    parser.add_argument('--report', type=str,
+                        help='write api call counts and latencies, retries, downloaded bytes, stage and render '
+                             'timings and peak memory to this JSON file')
+    parser.add_argument('--profile', type=str,
+                        help='profile the main thread of the run and save results to this file')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile',
+                        help='profiler for --profile: cprofile writes pstats file, pyinstrument (if installed) '
+                             'writes html page (default: %(default)s)')
     args = parser.parse_args(argv)
+    if args.action == 'search' and not args.query:
+        parser.error('search action needs --query')
+    if args.action == 'search':
+        try:
+            check_query(args.query)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.bundle and args.photo_size != 'original':
+        parser.error('--photo-size works without --bundle only')
+    if args.input and (args.action in ('json', 'search', 'serve') or args.peer_id == 'all' or ',' in args.peer_id):
+        parser.error('--input works with a single peer_id and actions text, html, archive, audio and photo')
+    try:
+        profiler = Profiler(args.profiler) if args.profile else None
+    except RuntimeError as e:
+        parser.error(str(e))
 
-    m = vk_msg.VkMessages(API(Session(access_token=args.token)))
-    actions = {
-        'text': lambda x, y: print_list(vk_msg.text_repr(x, y)),
-        'json': lambda: m.save('.', args.peer_id),
-        'audio': lambda x: print_list([x for x in [a.get('url', None) for a in vk_msg.audio_links(x)] if x]),
-        'photo': lambda x: print_list([p['biggest'] for p in vk_msg.photo_links(x)]),
-        'html': lambda x, y, z, h: html_backup.render('.', args.peer_id, x, y, z, h),
-        'archive': lambda x, y, z, h: archive.make('.', args.peer_id, x, y, z, h)
-    }
-    action_args = []
-    if not args.action == 'json':
-        messages = m.get_all_from(args.peer_id)
-        action_args.append(messages)
-        if args.action in ('text', 'html', 'archive'):
-            part = m.participants(messages)
-            action_args.append(part)
-        if args.action in ('html', 'archive'):
-            audio_links = vk_msg.audio_links(messages)
-            action_args.append(audio_links)
-            photo_links = vk_msg.photo_links(messages)
-            action_args.append(photo_links)
-        actions[args.action](*action_args)
+    if profiler is not None:
+        profiler.start()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.stop(args.profile)
+        if args.report:
+            metrics.write_report(args.report)
+
+
+def run(args):
+    """Run action of parsed command line arguments."""
+    m = vk_msg.VkMessages(API(Session(access_token=args.token)),
+                          RateLimiter(args.rate),
+                          UserCache(args.store, args.user_ttl * 24 * 3600),
+                          args.fetch_workers)
+    store = MessageStore(args.store)
+    search_index = SearchIndex(args.store)
+    if args.action == 'search':
+        search(args, m, store, search_index)
+        return
+    if args.action == 'serve':
+        if args.peer_id == 'all':
+            peer = None
+        elif args.peer_id.startswith('chat') or args.peer_id.isdigit():
+            peer = args.peer_id
+        else:
+            peer = str(m.get_user(args.peer_id)['uid'])
+        server.serve(server.Viewer(store, m, '.'), args.host, args.port, peer)
+        return
+    if args.peer_id == 'all':
+        peers = [(peer_id, 'chat{}'.format(peer_id) if is_chat else str(peer_id), is_chat)
+                 for peer_id, is_chat in m.dialogs()]
     else:
-        actions[args.action]()
+        peers = [(peer_id, peer_id, False) for peer_id in args.peer_id.split(',')]
+    downloader = Downloader(args.workers) if args.action == 'archive' else None
+    bundle = Bundle(args.bundle) if args.action == 'archive' and args.bundle else None
+    blobs = BlobStore('.') if args.action == 'archive' and bundle is None else None
+    thumbnailer = Thumbnailer() if args.action == 'archive' and args.thumbnails else None
+    originals = {} if blobs is not None and args.originals else None  # photo url -> files of smaller version
+
+    try:
+        if len(peers) == 1 and args.peer_id != 'all':
+            backup(args, m, store, *peers[0], downloader=downloader, blobs=blobs,
+                   search_index=search_index, thumbnailer=thumbnailer, bundle=bundle, originals=originals)
+        else:
+            def run_peer(peer):
+                try:
+                    return backup(args, m, store, *peer, downloader=downloader, blobs=blobs, to_file=True,
+                                  search_index=search_index, thumbnailer=thumbnailer, bundle=bundle,
+                                  originals=originals)
+                except Exception as e:  # one failed peer should not stop the others
+                    return dict(peer=peer[1], error='{}: {}'.format(type(e).__name__, e))
+
+            with ThreadPoolExecutor(args.jobs) as pool:
+                summaries = list(pool.map(run_peer, peers))
+            print_summary(summaries)
+        if originals:
+            with metrics.timer('stage.originals'):
+                archive.fetch_originals(blobs, downloader, originals)
+    finally:
+        if bundle is not None:
+            bundle.close()
 
 
 if __name__ == '__main__':
@@ -1,162 +1,295 @@
-import json
 import os
-import time
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Union, Any
+from typing import List, Dict, Union, Any, Iterable, Iterator, Optional, Set, TextIO, Tuple
 
 from vk.api import API as VKAPI
 from tqdm import tqdm
 
+from vkbackup import columnar as columnar_format, jsonstream, parallel
+from vkbackup.ratelimit import RateLimiter, RateLimitedAPI
+from vkbackup.store import MessageStore, peer_key
+from vkbackup.user_cache import UserCache, user_key
 
-def attachments_of_type(msgs: List[Dict], attach_type: str) -> List[Dict]:
-    """Attachment objects of certain type. Also looks to fwd messages."""
-    return [
-               attach
-               for msg in msgs if 'attachments' in msg
-               for attach in msg['attachments'] if attach['type'] == attach_type
-               ] + [
-               attach
-               for msg in msgs if 'fwd_messages' in msg
-               for fwd_msg in msg['fwd_messages'] if 'attachments' in fwd_msg
-               for attach in fwd_msg['attachments'] if attach['type'] == attach_type
-               ]
+
+AttachmentIndex = Dict[str, List[Tuple[int, Dict]]]
+
+
+def index_attachments(msgs: Iterable[Dict]) -> AttachmentIndex:
+    """Attachments of every type in one pass over messages.
+
+    Looks into forwarded messages at any depth and into attached wall posts and their reposts.
+
+    :param msgs: messages, can be a generator
+    :return: dict from attachment type to list of (id of top-level message, attachment object)
+    """
+    index = {}
+
+    def visit(mid: int, attachments: List[Dict]) -> None:
+        for attach in attachments:
+            index.setdefault(attach['type'], []).append((mid, attach))
+            if attach['type'] == 'wall':
+                visit_wall(mid, attach['wall'])
+
+    def visit_wall(mid: int, wall: Dict) -> None:
+        visit(mid, wall.get('attachments', None) or [])
+        for repost in wall.get('copy_history', None) or []:
+            visit_wall(mid, repost)
+
+    def visit_msg(mid: int, msg: Dict) -> None:
+        visit(mid, msg.get('attachments', None) or [])
+        for fwd_msg in msg.get('fwd_messages', None) or []:
+            visit_msg(mid, fwd_msg)
+
+    for msg in msgs:
+        visit_msg(msg.get('mid'), msg)
+    return index
+
+
+def attachments_of_type(msgs: List[Dict], attach_type: str, index: AttachmentIndex = None) -> List[Dict]:
+    """Attachment objects of certain type. Also looks to fwd messages and wall posts.
+
+    :param msgs: list of messages
+    :param attach_type: type of attachments
+    :param index: index made by index_attachments, to avoid walking messages again
+    """
+    if index is None:
+        index = index_attachments(msgs)
+    return [attach for mid, attach in index.get(attach_type, [])]
+
+
+def audio_to_text(audio: Dict) -> str:
+    """Text representation of audio attachment.
+
+    :param audio: attachment of type audio
+    :returns: string with audio info
+    """
+    return 'audio: {} - {}'.format(audio.get('performer') or audio.get('artist', None), audio.get('title', None))
+
+
+def photo_to_text(photo: Dict) -> str:
+    """Text representation of photo attachment (link).
+
+    :param photo: attachment of type photo
+    :returns: link to photo
+    """
+    return 'photo: {}'.format(photo.get('src_xxxbig') or photo.get('src_big', None))
+
+
+def sticker_to_text(sticker: Dict) -> str:
+    """Text representation of sticker.
+
+    :param sticker: attachment of type sticker
+    :returns: link to sticker
+    """
+    return 'sticker: {}'.format(sticker.get('photo_256', None))
+
+
+def doc_to_text(doc: Dict) -> str:
+    """Text representation of attached document.
+
+    :param doc: attachment of type doc
+    :returns: name and link to doc
+    """
+    return 'doc: {} {}'.format(doc.get('title'), doc.get('url'))
+
+
+def video_to_text(video: Dict) -> str:
+    """Text representation of attached video.
+
+    :param video: attachment of type video
+    :returns: name of video
+    """
+    return 'video: {}'.format(video.get('title', None))
+
+
+def link_to_text(link: Dict) -> str:
+    """Text representation of attached link.
+
+    :param link: attachment of type link
+    :returns: link title and link itself
+    """
+    return 'link: {}({})'.format(link.get('title', None), link.get('url', None))
+
+
+def wall_to_text(wall: Dict) -> str:
+    """Text representation of wall post attachment
+
+    :param wall: attachment of type wall
+    :returns: wall text
+    """
+    attachments = wall.get('attachments', None) or []
+    return 'wall: {} {}'.format(
+        wall.get('text', None),
+        '' if not attachments else '[{}]'.format(attachments_to_text(attachments))
+    )
+
+
+ATTACHMENT_TO_TEXT = dict(photo=photo_to_text,
+                          audio=audio_to_text,
+                          sticker=sticker_to_text,
+                          doc=doc_to_text,
+                          video=video_to_text,
+                          link=link_to_text,
+                          wall=wall_to_text
+                          )
+
+
+def attachments_to_text(attachs: List[Dict]) -> str:
+    """Text representation of attachments in wall post or message.
+
+    :param attachs: non-empty attachments list
+    """
+    assert attachs
+    return ', '.join([
+                         ATTACHMENT_TO_TEXT[x['type']](x[x['type']])
+                         for x
+                         in attachs
+                         if x['type'] in ATTACHMENT_TO_TEXT
+                         ])
+
+
+_MINUTES_SECONDS = ['{:02d}:{:02d}'.format(*divmod(i, 60)) for i in range(3600)]
+_quarters = {}  # quarter of an hour since epoch -> (local 'YYYY-MM-DD HH:', seconds since start of local hour)
+
+
+def format_date(timestamp: int) -> str:
+    """Same as str(datetime.fromtimestamp(timestamp)), cached per quarter of an hour.
+
+    Local time offsets and their changes are multiples of 15 minutes, so every quarter of an
+    hour since epoch shares date and hour, and only minutes and seconds have to be looked up.
+    """
+    if type(timestamp) is not int:
+        return str(datetime.fromtimestamp(timestamp))
+    quarter, seconds = divmod(timestamp, 900)
+    try:
+        prefix, offset = _quarters[quarter]
+    except KeyError:
+        start = datetime.fromtimestamp(quarter * 900)
+        prefix, offset = _quarters[quarter] = str(start)[:14], start.minute * 60
+    return prefix + _MINUTES_SECONDS[offset + seconds]
+
+
+def user_full_name(user: Dict) -> str:
+    """Convert user object to full name."""
+    return ' '.join((user['first_name'], user['last_name']))
+
+
+def message_to_text(msg: Dict, participants: Dict, user: str = None, peer: str = None, date: bool = True) -> str:
+    """Text representation of message, forwarded messages included.
+
+    :param msg: message object
+    :param participants: participants dict
+    :param user: name to show for outgoing message
+    :param peer: name to show for incoming message, by default sender name is taken from participants
+    :param date: whether to prefix message with its date
+    """
+    attachments = msg.get('attachments', None)
+    return '{}{}{}{}'.format(
+        '{}{}: '.format(
+            format_date(msg['date']) + ' ' if date else '',
+            (user if 'out' in msg and msg['out'] else peer) or user_full_name(participants[msg['from_id']])
+        ),
+        msg['body'],
+        '\n    >' + '\n    >'.join([
+                                          message_to_text(fwd_msg,
+                                                          participants,
+                                                          'out',
+                                                          user_full_name(participants[fwd_msg['uid']]),
+                                                          date)
+                                          for fwd_msg
+                                          in msg['fwd_messages']
+                                          ]) if 'fwd_messages' in msg else '',
+        ' [{}]'.format(attachments_to_text(attachments)) if attachments else ''
+    )
 
 
 def text_repr(msgs: List[Dict],
               participants: Dict,
               user_name: str = None,
               peer_name: str = None,
-              date: bool = True) -> List[str]:
+              date: bool = True,
+              processes: int = 1) -> List[str]:
     """Text representation of conversation.
 
     :param msgs: messages list
     :param participants: participants dict
     :param user_name: name of user, which runs script
     :param peer_name: name of peer
+    :param processes: number of processes converting chunks of messages, None for one per cpu core
     :return: list of dialogue lines
     """
+    return list(iter_text(msgs, participants, user_name, peer_name, date, processes))
 
-    def audio_to_text(audio) -> str:
-        """Text representation of audio attachment.
-
-        :param audio: attachment of type audio
-        :returns: string with audio info
-        """
-        return 'audio: {} - {}'.format(audio.get('performer') or audio.get('artist', None), audio.get('title', None))
-
-    def photo_to_text(photo) -> str:
-        """Text representation of photo attachment (link).
-
-        :param photo: attachment of type photo
-        :returns: link to photo
-        """
-        return 'photo: {}'.format(photo.get('src_xxxbig') or photo.get('src_big', None))
 
-    def sticker_to_text(sticker) -> str:
-        """Text representation of sticker.
+def iter_text(msgs: Iterable[Dict],
+              participants: Dict,
+              user_name: str = None,
+              peer_name: str = None,
+              date: bool = True,
+              processes: int = 1) -> Iterator[str]:
+    """Text representation of conversation, made lazily message by message.
 
-        :param sticker: attachment of type sticker
-        :returns: link to sticker
-        """
-        return 'sticker: {}'.format(sticker.get('photo_256', None))
+    :param msgs: messages, can be a generator
+    :param participants: participants dict
+    :param user_name: name of user, which runs script
+    :param peer_name: name of peer
+    :param processes: number of processes converting chunks of messages, None for one per cpu core
+    :return: generator of dialogue lines
+    """
+    if processes != 1:
+        yield from parallel.imap_chunks(iter_text, msgs, (participants, user_name, peer_name, date), processes)
+        return
+    for msg in msgs:
+        yield message_to_text(msg, participants, user_name, peer_name, date)
 
-    def doc_to_text(doc) -> str:
-        """Text representation of attached document.
 
-        :param doc: attachment of type doc
-        :returns: name and link to doc
-        """
-        return 'doc: {} {}'.format(doc.get('title'), doc.get('url'))
+def write_lines(lines: Iterable[str], f: TextIO, batch: int = 1000) -> None:
+    """Write lines to file, same as printing them one by one, but in fewer writes.
 
-    def video_to_text(video) -> str:
-        """Text representation of attached video.
+    :param lines: lines without line ends, can be a generator
+    :param f: text file opened for writing
+    :param batch: number of lines joined into one write
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= batch:
+            f.write('\n'.join(chunk) + '\n')
+            chunk = []
+    if chunk:
+        f.write('\n'.join(chunk) + '\n')
 
-        :param video: attachment of type video
-        :returns: name of video
-        """
-        return 'video: {}'.format(video.get('title', None))
 
-    def link_to_text(link) -> str:
-        """Text representation of attached link.
+# fields of photo urls, from the smallest size to the largest
+PHOTO_FIELDS = ('src_small', 'src', 'src_big', 'src_xbig', 'src_xxbig', 'src_xxxbig')
+# largest field of every size tier: small is up to 130px, medium 604px, big 1280px
+PHOTO_SIZES = dict(small='src', medium='src_big', big='src_xxbig', original='src_xxxbig')
 
-        :param link: attachment of type link
-        :returns: link title and link itself
-        """
-        return 'link: {}({})'.format(link.get('title', None), link.get('url', None))
 
-    def wall_to_text(wall) -> str:
-        """Text representation of wall post attachment
+def photo_url(photo: Dict, size: str = 'original') -> Optional[str]:
+    """Url of the largest version of photo not above size tier, or the smallest one if all are larger.
 
-        :param wall: attachment of type wall
-        :returns: wall text
-        """
-        attachments = wall.get('attachments', None) or []
-        return 'wall: {} {}'.format(
-            wall.get('text', None),
-            '' if not attachments else '[{}]'.format(attachments_to_text(attachments))
-        )
+    :param photo: photo object made by photo_links, or photo of attachment
+    :param size: one of PHOTO_SIZES; 'original' is the same as 'biggest' of photo_links
+    """
+    limit = PHOTO_FIELDS.index(PHOTO_SIZES[size]) + 1
+    for field in PHOTO_FIELDS[limit - 1::-1] + PHOTO_FIELDS[limit:]:
+        if photo.get(field):
+            return photo[field]
+    return None
 
-    def attachments_to_text(attachs: List[Dict]) -> str:
-        """Text representation of attachments in wall post or message.
 
-        :param attachs: non-empty attachments list
-        """
-        assert attachs
-        attachment_funcs = dict(photo=photo_to_text,
-                                audio=audio_to_text,
-                                sticker=sticker_to_text,
-                                doc=doc_to_text,
-                                video=video_to_text,
-                                link=link_to_text,
-                                wall=wall_to_text
-                                )
-        attachments = ', '.join([
-                                    attachment_funcs[x['type']](x[x['type']])
-                                    for x
-                                    in attachs
-                                    if x['type'] in list(attachment_funcs.keys())
-                                    ])
-        return '{}'.format(attachments)
-
-    def user_full_name(user: Dict) -> str:
-        """Convert user object to full name."""
-        return ' '.join((user['first_name'], user['last_name']))
-
-    def fwd_to_text(fwd):
-        """Text representation of forwarded messages.
-
-        :param fwd: message['fwd_messages']
-        """
-        return '\n    >' + '\n    >'.join([
-                                              to_dialogue(fwd_msg,
-                                                          'out',
-                                                          user_full_name(participants[fwd_msg['uid']]))
-                                              for fwd_msg
-                                              in fwd
-                                              ])
-
-    def to_dialogue(msg, user, peer) -> str:
-        attachments = msg.get('attachments', None)
-        return '{}{}{}{}'.format(
-            '{}{}: '.format(
-                str(datetime.fromtimestamp(msg['date'])) + ' ' if date else '',
-                (user if 'out' in msg and msg['out'] else peer) or user_full_name(participants[msg['from_id']])
-            ),
-            msg['body'],
-            fwd_to_text(msg['fwd_messages']) if 'fwd_messages' in msg else '',
-            ' [{}]'.format(attachments_to_text(attachments)) if attachments else ''
-        )
-
-    return [to_dialogue(msg, user_name, peer_name) for msg in msgs]
-
-
-def photo_links(msgs: List[Dict]) -> List[Dict[str, Any]]:
+def photo_links(msgs: List[Dict], index: AttachmentIndex = None) -> List[Dict[str, Any]]:
     """Get all links to attached photos in messages.
 
     :param msgs: list of messages
+    :param index: index made by index_attachments, to avoid walking messages again
     :return: list of links
     """
-    photo_attachments = attachments_of_type(msgs, 'photo')
+    photo_attachments = attachments_of_type(msgs, 'photo', index)
     return [dict(
         type='photo',
         src_big=photo['photo'].get('src_big', None),
@@ -171,13 +304,14 @@ def photo_links(msgs: List[Dict]) -> List[Dict[str, Any]]:
     ) for photo in photo_attachments]
 
 
-def audio_links(msgs: List[Dict]) -> List[Dict[str, Any]]:
+def audio_links(msgs: List[Dict], index: AttachmentIndex = None) -> List[Dict[str, Any]]:
     """Get all attached audio objects in message list.
 
     :param msgs: list of messages:
+    :param index: index made by index_attachments, to avoid walking messages again
     :return: list({name, link})
     """
-    audio_attachments = attachments_of_type(msgs, 'audio')
+    audio_attachments = attachments_of_type(msgs, 'audio', index)
     return [dict(
         type='audio',
         artist=audio['audio'].get('artist') or audio['audio'].get('performer', None),
@@ -187,77 +321,256 @@ def audio_links(msgs: List[Dict]) -> List[Dict[str, Any]]:
     ) for audio in audio_attachments]
 
 
+def participant_ids(msgs: List[Dict]) -> Set[int]:
+    """Ids of every user in conversation including forwarded messages."""
+    return set(
+        [msg['uid'] for msg in msgs] +
+        [msg['from_id'] for msg in msgs] +
+        [
+            fwd_msg['uid'] for msg in msgs if 'fwd_messages' in msg
+            for fwd_msg in msg['fwd_messages']
+            ]
+    )
+
+
+def placeholder_user(uid: int) -> Dict:
+    """User object standing for user not known offline."""
+    return dict(uid=uid, first_name='User', last_name=str(uid), screen_name='id{}'.format(uid))
+
+
+def load_dump(path: str) -> Iterator[Dict]:
+    """Messages saved by VkMessages.save, read one by one.
+
+    :param path: JSON array or JSON Lines file, or columnar archive folder
+    :return: generator of messages
+    """
+    if os.path.isdir(path):
+        yield from columnar_format.load(path)
+        return
+    with open(path, encoding='utf-8') as f:
+        yield from jsonstream.load(f)
+
+
 class VkMessages:
     """Convenient work with vk messages api."""
 
     API_VERSION = '4.100'
+    SYNC_OVERLAP = 200  # already stored messages to re-fetch, in case some were deleted since the last sync
+    USERS_PER_CALL = 1000  # users.get limit
+    CHUNK = 4000  # messages fetched by one execute call
+    CHUNK_OVERLAP = 200  # messages before chunk fetched too, to check it joins the previous one
 
-    def __init__(self, vkapi: VKAPI) -> None:
+    def __init__(self, vkapi: VKAPI, limiter: RateLimiter = None, users: UserCache = None,
+                 fetch_workers: int = 3) -> None:
         """
         :param vkapi: connected vk api
+        :param limiter: limiter for every api call, share it between instances using the same token
+        :param users: cache of resolved users, by default it is kept in memory for this instance only
+        :param fetch_workers: number of concurrent execute calls fetching history of one conversation
         """
-        self.vkapi = vkapi
+        self.vkapi = RateLimitedAPI(vkapi, limiter or RateLimiter())
+        self.users = users or UserCache()
+        self.fetch_workers = fetch_workers
 
-    def get_all_from(self, id: Union[str, int], is_chat: bool = False) -> List[Dict]:
+    def get_all_from(self, id: Union[str, int], is_chat: bool = False, offset: int = 0) -> List[Dict]:
         """Fetches all messages from user conversation or group chat.
 
         :param id: chat_id or user_id or screen name
         :param is_chat: if True, user_id is treated as chat_id
+        :param offset: number of oldest messages to skip
         :return: list of message objects (dicts)
         """
-        messages_gethistory_params = {
-            'offset': '0',
-            'count': '200',
-            'id': id if is_chat else self.get_user(str(id))['uid'],
-            'rev': '1'
-        }
-        all_messages = []
-        n = 0
-        total = (self.vkapi.messages.getHistory(chat_id=messages_gethistory_params['id'], count=0, v=self.API_VERSION)
-                if is_chat
-                else self.vkapi.messages.getHistory(user_id=messages_gethistory_params['id'], count=0, v=self.API_VERSION))
-        print('Going to fetch {} messages'.format(total))
+        return [msg for batch in self.iter_from(id, is_chat, offset) for msg in batch]
+
+    def iter_from(self, id: Union[str, int], is_chat: bool = False, offset: int = 0,
+                  after: int = None) -> Iterator[List[Dict]]:
+        """Fetches messages from user conversation or group chat batch by batch.
+
+        Total number of messages is known in advance, so offset ranges of CHUNK messages are
+        fetched by fetch_workers concurrent execute calls (within rate limit) and yielded in order.
+        Ranges overlap a bit; duplicates are dropped, and gaps left by messages deleted during
+        the fetch are filled by fetching further back. Messages arrived during the fetch are
+        fetched after the known range.
+
+        :param id: chat_id or user_id or screen name
+        :param is_chat: if True, user_id is treated as chat_id
+        :param offset: number of oldest messages to skip
+        :param after: id of the last message fetched before, only messages after it are yielded; offset is
+                      just a guess then, fetch goes further back if messages deleted since moved it past that one
+        :return: generator of lists of message objects (dicts), in chronological order
+        """
+        peer_id = int(id if is_chat else self.get_user(str(id))['uid'])
+        total = (self.vkapi.messages.getHistory(chat_id=peer_id, count=0, v=self.API_VERSION)
+                 if is_chat
+                 else self.vkapi.messages.getHistory(user_id=peer_id, count=0, v=self.API_VERSION))
+        print('Going to fetch {} messages'.format(total), file=sys.stderr)  # stdout is for exported data
         total = total[0]
-        with tqdm(desc='Downloading messages', unit='msg', total=total) as progress:
-            while True:
-                msg_query_part = '''API.messages.getHistory({{"offset": {offset}, "count": 200, ''' + \
-                                 ('''"user_id" ''' if not is_chat else '''"chat_id" ''') + ''': {id}, "rev": {rev}}})+'''
-                msg_query = 'return '
-                for i in range(n, n + 4000, 200):
-                    msg_query += msg_query_part.format(offset=i,
-                                                       id=int(messages_gethistory_params['id']),
-                                                       rev=int(messages_gethistory_params['rev']))
-                msg_query = msg_query.strip('+')
-                msg_query += ';'
-
-                current_bulk = self.vkapi.execute(code=msg_query, v=self.API_VERSION)
-                time.sleep(1)
-
-                all_messages.append(current_bulk)
-                n += len(current_bulk)
-                progress.update(len(current_bulk))
-                # print('Inserted {} elements.\nlast: {}'.format(n, all_messages[-1][-1]))
-                if type(current_bulk[-1]) is int:
-                    break
-
-        flat = [y for x in all_messages for y in x]
-        cleaned = [x for x in flat if type(x) is not int]
-        return cleaned
-
-    def participants(self, msgs: List[Dict]) -> Dict[str, Dict]:
-        """User info for every user in conversation including forwarded messages."""
+        starts = range(offset, total, self.CHUNK)
+        last_mid = after
+        done = False
+        with tqdm(desc='Downloading messages', unit='msg', total=max(total - offset, 0)) as progress, \
+                ThreadPoolExecutor(self.fetch_workers) as pool:
+            pending = deque()
+            for start in starts:
+                pending.append((start, pool.submit(self._fetch_chunk, peer_id, is_chat, start, start > offset)))
+                if len(pending) < 2 * self.fetch_workers:  # keep few chunks ahead, not the whole history
+                    continue
+                chunk_start, future = pending.popleft()
+                batch, done = self._stitch(peer_id, is_chat, chunk_start, future.result(), last_mid)
+                if batch:
+                    last_mid = batch[-1]['mid']
+                    progress.update(len(batch))
+                    yield batch
+            while pending:
+                chunk_start, future = pending.popleft()
+                batch, done = self._stitch(peer_id, is_chat, chunk_start, future.result(), last_mid)
+                if batch:
+                    last_mid = batch[-1]['mid']
+                    progress.update(len(batch))
+                    yield batch
+            n = starts[-1] + self.CHUNK if starts else offset
+            while not done:  # history grew while it was fetched
+                batch, done = self._stitch(peer_id, is_chat, n, self._fetch_chunk(peer_id, is_chat, n), last_mid)
+                if batch:
+                    last_mid = batch[-1]['mid']
+                    progress.update(len(batch))
+                    yield batch
+                n += self.CHUNK
+
+    def _fetch_chunk(self, peer_id: int, is_chat: bool, start: int, overlap: bool = True) -> Tuple[List[Dict], bool]:
+        """Fetch CHUNK messages from offset start, plus CHUNK_OVERLAP messages before it, in one execute call.
+
+        :param overlap: if False, messages before start are not fetched
+        :return: messages and whether the end of history is reached
+        """
+        msg_query_part = '''API.messages.getHistory({{"offset": {offset}, "count": 200, ''' + \
+                         ('''"user_id" ''' if not is_chat else '''"chat_id" ''') + ''': {id}, "rev": 1}})'''
+        first = max(start - self.CHUNK_OVERLAP, 0) if overlap else start
+        msg_query = 'return ' + '+'.join(msg_query_part.format(offset=i, id=peer_id)
+                                         for i in range(first, start + self.CHUNK, 200)) + ';'
+        current_bulk = self.vkapi.execute(code=msg_query, v=self.API_VERSION)
+        # each getHistory result starts with count, lone count at the end means there are no more messages
+        return [x for x in current_bulk if type(x) is not int], type(current_bulk[-1]) is int
+
+    def _stitch(self, peer_id: int, is_chat: bool, start: int, chunk: Tuple[List[Dict], bool],
+                last_mid: Optional[int]) -> Tuple[List[Dict], bool]:
+        """Join fetched chunk to messages yielded before it.
+
+        :param start: offset chunk was fetched from
+        :param chunk: result of _fetch_chunk
+        :param last_mid: id of the last yielded message, None if nothing is yielded yet
+        :return: messages of chunk not yielded yet and whether the end of history is reached
+        """
+        msgs, done = chunk
+        if last_mid is None:
+            return msgs, done
+        # ids grow with time, so chunk starting after last_mid, or empty one, means messages before it
+        # were deleted, shifting offsets past the overlap: look further back
+        while (not msgs or msgs[0]['mid'] > last_mid) and start > 0:
+            tqdm.write('Gap before offset {}, fetching again'.format(start))
+            start = max(start - self.CHUNK, 0)
+            msgs = self._fetch_chunk(peer_id, is_chat, start)[0] + msgs
+            msgs = sorted({msg['mid']: msg for msg in msgs}.values(), key=lambda msg: msg['mid'])
+        return [msg for msg in msgs if msg['mid'] > last_mid], done
+
+    def sync(self, store: MessageStore, id: Union[str, int], is_chat: bool = False) -> str:
+        """Fetches messages not yet present in store and saves them there.
+
+        The walk starts right after the stored part of history, so only newer messages are downloaded.
+
+        :param store: local message store
+        :param id: chat_id or user_id or screen name
+        :param is_chat: if True, user_id is treated as chat_id
+        :return: peer key of conversation in store
+        """
+        for _ in self.iter_sync(store, id, is_chat):
+            pass
+        return peer_key(id if is_chat else self.get_user(str(id))['uid'], is_chat)
+
+    def iter_sync(self, store: MessageStore, id: Union[str, int], is_chat: bool = False) -> Iterator[List[Dict]]:
+        """Same as sync, yielding every fetched batch once it is stored.
+
+        Fetch starts SYNC_OVERLAP messages before the stored count, and goes further back if more than
+        that were deleted on server; only messages after the last stored one are yielded.
+
+        :param store: local message store
+        :param id: chat_id or user_id or screen name
+        :param is_chat: if True, user_id is treated as chat_id
+        :return: generator of lists of message objects, in chronological order
+        """
+        peer_id = id if is_chat else self.get_user(str(id))['uid']
+        key = peer_key(peer_id, is_chat)
+        offset = max(store.count(key) - self.SYNC_OVERLAP, 0)
+        added = 0
+        for batch in self.iter_from(peer_id, is_chat, offset=offset, after=store.last_mid(key)):
+            added += store.add(key, batch)
+            yield batch
+        print('{} new messages stored, last synced message id: {}'.format(added, store.last_mid(key)),
+              file=sys.stderr)
+
+    def dialogs(self) -> List[Tuple[int, bool]]:
+        """All conversations of the user, most recent first.
+
+        :return: list of (user_id or chat_id, is_chat)
+        """
+        peers = []
+        offset = 0
+        while True:
+            page = self.vkapi.messages.getDialogs(offset=offset, count=200, v=self.API_VERSION)
+            dialogs = [d for d in page if type(d) is not int]
+            peers += [(d['chat_id'], True) if 'chat_id' in d else (d['uid'], False) for d in dialogs]
+            offset += len(dialogs)
+            if not dialogs or offset >= page[0]:
+                return peers
+
+    def participants(self, msgs: List[Dict], offline: bool = False) -> Dict[str, Dict]:
+        """User info for every user in conversation including forwarded messages.
+
+        :param msgs: messages list
+        :param offline: take users from user cache only, however old, without api calls;
+                        users missing there get placeholders named by id
+        """
+        uids = participant_ids(msgs)
+        if offline:
+            users = self.users.get_many(map(str, uids), stale=True) if self.users is not None else {}
+            users = {uid: users.get(str(uid)) or placeholder_user(uid) for uid in uids}
+        else:
+            users = self.get_users(uids)
         return {u['uid']: {key: u[key] for key in u if key != 'uid'}
                 for u
-                in list(map(self.get_user,
-                            set(
-                                [msg['uid'] for msg in msgs] +
-                                [msg['from_id'] for msg in msgs] +
-                                [
-                                    fwd_msg['uid'] for msg in msgs if 'fwd_messages' in msg
-                                    for fwd_msg in msg['fwd_messages']
-                                    ]
-                            )
-                            ))}
+                in users.values()}
+
+    def get_users(self, user_ids: Iterable[Union[str, int]]) -> Dict[str, 'User']:
+        """Batched and cached wrapper for users.get call.
+
+        Only users missing in cache are requested, up to USERS_PER_CALL per call.
+
+        :param user_ids: screen names or ids
+        :return: dict from requested id or screen name (as str) to user object
+        """
+        wanted = {str(u) for u in user_ids}
+        found = self.users.get_many(wanted)
+        missing = sorted(wanted - found.keys())
+        for i in range(0, len(missing), self.USERS_PER_CALL):
+            chunk = missing[i:i + self.USERS_PER_CALL]
+            fetched = self.vkapi.users.get(
+                user_ids=','.join(chunk),
+                fields='name,screen_name',
+                v=self.API_VERSION
+            )
+            self.users.put_many(fetched)
+            by_key = {}
+            for user in fetched:
+                by_key[user_key(str(user['uid']))] = user
+                if user.get('screen_name'):
+                    by_key[user_key(user['screen_name'])] = user
+            for user_id in chunk:
+                user = by_key.get(user_key(user_id))
+                if user is None and len(chunk) == 1 and len(fetched) == 1:
+                    user = fetched[0]  # vk resolved it some other way, like an old screen name
+                if user is not None:
+                    found[user_id] = user
+        return found
 
     def get_user(self, user_id: Union[str, int]) -> 'User':
         """Wrapper for users.get call.
@@ -265,24 +578,40 @@ class VkMessages:
         :param user_id: screen name or id
         :return: user object with name and screen_name
         """
-        time.sleep(1)
-        return self.vkapi.users.get(
-            user_ids=str(user_id),
-            fields='name,screen_name',
-            v=self.API_VERSION
-        )[0]
-
-    def save(self, path: str, user_id: Union[str, int]) -> None:
+        return self.get_users([user_id])[str(user_id)]
+
+    def save(self, path: str, user_id: Union[str, int], store: MessageStore = None, lines: bool = False,
+             is_chat: bool = False, columnar: bool = False) -> None:
         """Save messages to json file.
 
+        Messages are written as they come, so memory use does not depend on conversation length.
+
         :param path: path to file, like /home/user/folder
         :param user_id: screen name or id
+        :param store: if given, messages are synced into it and read from there
+        :param lines: write JSON Lines (one message per line) instead of JSON array
+        :param is_chat: if True, user_id is treated as chat_id
+        :param columnar: save compressed columnar archive folder instead, see columnar.write
         """
-        user = self.get_user(user_id)
-        filename = '{} {} ({}).{}'.format(user['first_name'],
-                                          user['last_name'],
-                                          str(datetime.now().date()),
-                                          'json')
-        msgs = self.get_all_from(user['uid'])
+        if is_chat:
+            peer_id = user_id
+            name = 'chat{}'.format(user_id)
+        else:
+            user = self.get_user(user_id)
+            peer_id = user['uid']
+            name = '{} {}'.format(user['first_name'], user['last_name'])
+        filename = '{} ({}).{}'.format(name,
+                                       str(datetime.now().date()),
+                                       'vkcol' if columnar else 'jsonl' if lines else 'json')
+        if store is not None:
+            msgs = store.messages(self.sync(store, peer_id, is_chat))
+        else:
+            msgs = (msg for batch in self.iter_from(peer_id, is_chat) for msg in batch)
+        if columnar:
+            columnar_format.write(os.path.join(path, filename), msgs)
+            return
         with open(os.path.join(path, filename), mode='w') as f:
-            f.write(json.dumps(msgs))
+            if lines:
+                jsonstream.dump_lines(msgs, f)
+            else:
+                jsonstream.dump_array(msgs, f)